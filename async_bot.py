@@ -0,0 +1,559 @@
+"""Asyncio entry point for the Crypto Tracker Bot.
+
+Runs the same menus and texts as bot.py on telebot's AsyncTeleBot, with
+non-blocking Binance and Gemini calls. Only chart rendering, which is CPU
+bound, leaves the event loop for a thread pool. Start it with
+`python async_bot.py` instead of `python bot.py`.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+import google.generativeai as genai
+
+import bot as app
+from binance_api import AsyncBinanceClient
+from cache import AsyncSingleFlight, next_candle_close
+from metrics import CALLBACK_SECONDS, CALLBACKS, STAGE_SECONDS, log_error, log_event, new_request_id
+from outbox import AsyncOutbox, telegram_retry_after
+from workers import ParallelStage
+
+bot = AsyncTeleBot(app.API_TOKEN)
+
+# Telegram calls share bot.py's send queue and its rate limits, see outbox.AsyncOutbox
+outbox = AsyncOutbox(bot, app.send_queue)
+
+# Shares the weight budget with the ticker snapshot's thread
+binance = AsyncBinanceClient(pool_size=int(os.environ.get("BINANCE_POOL_SIZE", 100)), limiter=app.binance_limiter)
+
+# Matplotlib holds the GIL, a couple of threads is all rendering can use
+render_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CHART_WORKERS", 2)),
+    thread_name_prefix='render'
+)
+
+kline_flights = AsyncSingleFlight()
+ai_flights = AsyncSingleFlight()
+
+# (chat_id, callback data) of slow callbacks still running, repeated clicks are dropped
+running_jobs = set()
+
+async def get_binance_ohlc(symbol, interval, limit):
+    """Fetch OHLCV data without blocking the loop, sharing bot.py's kline cache"""
+    key = (symbol, interval, limit)
+    df = app.kline_cache.peek(key)
+    if df is not None:
+        return df
+
+    async def fetch():
+        # Stored by another flight since the peek above
+        df = app.kline_cache.peek(key)
+        if df is not None:
+            return df
+        expires_at = next_candle_close(interval)
+        try:
+            df = app.klines_to_frame(await binance.klines(symbol, interval, limit))
+        except Exception as e:
+            log_error('klines', e, symbol=symbol, interval=interval)
+            return None
+        app.kline_cache.store(key, df, expires_at)
+        return df
+
+    return await kline_flights.do(key, fetch)
+
+async def fetch_request_data(coin_full_name, timeframes):
+    """Async version of bot.fetch_request_data, under the same FETCH_DEADLINE"""
+    views = app.chart_views(coin_full_name, timeframes)
+    unique_views = list(dict.fromkeys(views.values()))
+    plan = app.kline_planner.plan(unique_views)
+
+    coros = {
+        f"klines {symbol} {interval}": get_binance_ohlc(symbol, interval, limit)
+        for (symbol, interval), limit in plan.items()
+    }
+    coros['ticker'] = get_current_data(app.coins.symbol(coin_full_name))
+
+    stage = await ParallelStage.run_async('fetch', coros, app.FETCH_DEADLINE)
+    app.log_stage(stage, 'fetch', f"{coin_full_name} {'/'.join(timeframes)}")
+
+    frames = {(symbol, interval): stage.values[f"klines {symbol} {interval}"] for symbol, interval in plan}
+    frames, _, _ = app.kline_planner.assemble(unique_views, plan, frames)
+    return app.charts_from_frames(timeframes, views, frames), stage.values.get('ticker')
+
+async def get_current_data(symbol):
+    """Current price and 24h change, from the ticker snapshot once it has loaded"""
+    if app.ticker_snapshot.loaded:
+        return app.get_current_data(symbol)
+
+    try:
+        data = await binance.ticker_24hr(symbol)
+        return {
+            'last_price': float(data['lastPrice']),
+            'price_change_percent': float(data['priceChangePercent'])
+        }
+    except Exception as e:
+        log_error('ticker', e, symbol=symbol)
+        return None
+
+async def render_chart(chart, coin_full_name, timeframe):
+    """Render (or fetch from the chart cache) a PNG on the render pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(render_pool, app.render_chart, chart, coin_full_name, timeframe)
+
+async def run_ai_analysis(coin_full_name, lang, on_progress=None):
+    """Async version of bot.run_ai_analysis, the three charts render concurrently.
+
+    `on_progress`, if given, is awaited with the text streamed so far.
+    """
+    started = time.perf_counter()
+
+    charts, current_data = await fetch_request_data(coin_full_name, ['1h', '1w', '1m'])
+
+    if not all(charts.values()):
+        raise Exception("Failed to generate one or more charts")
+
+    if app.AI_INPUT == 'features':
+        contents = app.feature_contents(coin_full_name, lang, charts, current_data)
+    else:
+        loop = asyncio.get_running_loop()
+        images = await asyncio.gather(*(
+            loop.run_in_executor(render_pool, app.chart_image, charts[timeframe], coin_full_name, timeframe)
+            for timeframe in ('1h', '1w', '1m')
+        ))
+        contents = app.image_contents(coin_full_name, lang, images, current_data)
+
+    seconds = time.perf_counter() - started
+    STAGE_SECONDS.observe(seconds, stage='ai_input')
+    log_event('ai_input_ready', coin=coin_full_name, mode=app.AI_INPUT, ms=round(seconds * 1000))
+
+    model = genai.GenerativeModel('gemini-2.5-flash')
+
+    with STAGE_SECONDS.time(stage='gemini'):
+        if on_progress is None:
+            response_text = (await model.generate_content_async(contents)).text
+        else:
+            response_text = ''
+            async for chunk in await model.generate_content_async(contents, stream=True):
+                response_text += chunk.text
+                await on_progress(response_text)
+
+    try:
+        return app.parse_ai_signal(response_text)
+    except Exception as e:
+        raise app.AIResponseError(str(e), response_text)
+
+async def get_ai_signal(coin_full_name, lang, on_progress=None):
+    """Return the signal from bot.py's AI cache, concurrent misses share one Gemini call"""
+    key = app.ai_cache_key(coin_full_name, lang)
+    loop = asyncio.get_running_loop()
+    # The cache is shared with the sync handlers and put() writes its file, keep both off the loop
+    signal = await loop.run_in_executor(None, app.ai_cache.lookup, key)
+    if signal is not None:
+        return signal
+
+    async def compute():
+        app.ai_cache.miss()
+        signal = await run_ai_analysis(coin_full_name, lang, on_progress)
+        await loop.run_in_executor(None, app.ai_cache.put, key, signal)
+        return signal
+
+    return await ai_flights.do(key, compute)
+
+async def send_long_message(chat_id, text, parse_mode=None):
+    """Send long message by splitting into parts"""
+    max_length = 4096
+    while len(text) > max_length:
+        part = text[:max_length]
+        await outbox.send_message(chat_id, part, parse_mode=parse_mode)
+        text = text[max_length:]
+    if text:
+        await outbox.send_message(chat_id, text, parse_mode=parse_mode)
+
+async def chat_language(chat_id):
+    """bot.py's preferences.language(), a chat's first lookup reads the database off the loop"""
+    if app.preferences.cached(chat_id):
+        return app.preferences.language(chat_id)
+    return await asyncio.get_running_loop().run_in_executor(None, app.preferences.language, chat_id)
+
+async def set_chat_language(chat_id, lang):
+    if app.preferences.cached(chat_id):
+        app.preferences.set_language(chat_id, lang)
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, app.preferences.set_language, chat_id, lang)
+
+@bot.message_handler(commands=['start'])
+async def send_welcome(message):
+    chat_id = message.chat.id
+    lang = await chat_language(chat_id)
+    await outbox.reply_to(message, app.texts[lang]['select_language'], reply_markup=app.create_language_keyboard())
+
+@bot.message_handler(commands=['donate'])
+async def send_donation(message):
+    chat_id = message.chat.id
+    lang = await chat_language(chat_id)
+    await outbox.reply_to(
+        message,
+        app.texts[lang]['donation_thanks'],
+        reply_markup=app.create_donation_keyboard(),
+        parse_mode='HTML'
+    )
+
+async def handle_timeframe(call, lang):
+    """Fetch, render and send a chart"""
+    parts = call.data.split("_", 2)
+    coin = app.coin_from_callback(parts[1])
+    timeframe = parts[2]
+
+    if coin is None:
+        log_event('coin_not_found', value=parts[1])
+        await outbox.answer_callback_query(
+            call.id,
+            "❌ Sorry, this coin is not available",
+            show_alert=True
+        )
+        return
+
+    coin_full_name = coin.name
+
+    readable_timeframe = app.timeframe_labels[lang].get(timeframe, timeframe)
+
+    processing_msg = await outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=app.texts[lang]['loading_chart'].format(coin_full_name, readable_timeframe),
+        parse_mode='HTML'
+    )
+
+    try:
+        charts, current_data = await fetch_request_data(coin_full_name, [timeframe])
+        chart = charts[timeframe]
+
+        if chart and current_data:
+            cache_key, interval, _ = chart
+            caption = app.texts[lang]['chart_caption'].format(coin_full_name, readable_timeframe, current_data['last_price'], current_data['price_change_percent'])
+
+            # Resend a chart Telegram already has instead of uploading the PNG again
+            sent = False
+            file_id = app.chart_file_ids.get(cache_key)
+            if file_id:
+                try:
+                    await outbox.send_photo(
+                        call.message.chat.id,
+                        file_id,
+                        caption=caption,
+                        parse_mode='HTML'
+                    )
+                    sent = True
+                except ApiTelegramException as e:
+                    log_event('file_id_rejected', error=str(e))
+                    app.chart_file_ids.pop(cache_key)
+
+            if not sent:
+                photo_msg = await outbox.send_photo(
+                    call.message.chat.id,
+                    await render_chart(chart, coin_full_name, timeframe),
+                    caption=caption,
+                    parse_mode='HTML'
+                )
+                app.chart_file_ids.set(cache_key, photo_msg.photo[-1].file_id, next_candle_close(interval))
+
+            try:
+                await outbox.delete_message(call.message.chat.id, processing_msg.message_id)
+            except Exception:
+                pass
+
+            await outbox.send_message(
+                call.message.chat.id,
+                app.texts[lang]['another_coin'],
+                reply_markup=app.create_crypto_keyboard()
+            )
+
+        else:
+            await outbox.edit_message_text(
+                chat_id=call.message.chat.id,
+                message_id=processing_msg.message_id,
+                text=app.texts[lang]['error_chart'].format(coin_full_name, readable_timeframe),
+                parse_mode='HTML'
+            )
+
+    except Exception as e:
+        log_error('timeframe', e, coin=coin_full_name, timeframe=timeframe)
+        await outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=processing_msg.message_id,
+            text=app.texts[lang]['error_general'],
+            parse_mode='HTML'
+        )
+
+async def handle_ai(call, lang):
+    """Run the Gemini analysis for a coin"""
+    coin = app.coin_from_callback(call.data.split("_", 1)[1])
+
+    if coin is None:
+        log_event('coin_not_found', value=call.data)
+        await outbox.answer_callback_query(
+            call.id,
+            "❌ Sorry, this coin is not available",
+            show_alert=True
+        )
+        return
+
+    coin_full_name = coin.name
+
+    processing_msg = await outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=app.texts[lang]['loading_ai'].format(coin_full_name),
+        parse_mode='HTML'
+    )
+
+    throttle = app.EditThrottle(app.AI_STREAM_EDIT_INTERVAL)
+
+    async def show_progress(response_text):
+        preview = app.stream_preview(response_text, lang)
+        if preview is None or not throttle.ready(preview):
+            return
+        try:
+            await outbox.edit_message_text(
+                chat_id=call.message.chat.id,
+                message_id=processing_msg.message_id,
+                text=preview,
+                parse_mode='HTML'
+            )
+        except ApiTelegramException as e:
+            throttle.backoff(telegram_retry_after(e))
+
+    try:
+        try:
+            signal = await get_ai_signal(coin_full_name, lang, show_progress if app.AI_STREAM else None)
+            analysis_text, keyboard = app.format_ai_report(coin_full_name, signal, lang)
+        except app.AIResponseError as parse_e:
+            log_error('ai_parse', parse_e, coin=coin_full_name)
+            analysis_text = f"<b>AI Analysis:</b>\n\n{parse_e.text}"
+            keyboard = app.create_crypto_keyboard()
+
+        # The processing message already shows the streamed analysis, finish it in place
+        finished_in_place = False
+        if throttle.edits and len(analysis_text) <= 4096:
+            try:
+                await outbox.edit_message_text(
+                    chat_id=call.message.chat.id,
+                    message_id=processing_msg.message_id,
+                    text=analysis_text,
+                    parse_mode='HTML'
+                )
+                finished_in_place = True
+            except ApiTelegramException as e:
+                log_error('ai_stream', e, coin=coin_full_name)
+
+        if not finished_in_place:
+            await send_long_message(call.message.chat.id, analysis_text, parse_mode='HTML')
+
+        await outbox.send_message(
+            call.message.chat.id,
+            app.texts[lang]['another_coin'],
+            reply_markup=keyboard
+        )
+
+        if not finished_in_place:
+            try:
+                await outbox.delete_message(call.message.chat.id, processing_msg.message_id)
+            except Exception:
+                pass
+
+    except Exception as e:
+        log_error('ai', e, coin=coin_full_name)
+        await outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=processing_msg.message_id,
+            text=app.texts[lang]['error_ai'],
+            parse_mode='HTML'
+        )
+
+async def run_slow_job(call, handler, lang, action):
+    """Run a slow callback unless the same one is already running for this chat"""
+    job_key = (call.message.chat.id, call.data)
+    if job_key in running_jobs:
+        CALLBACKS.inc(action=action, outcome='duplicate')
+        await outbox.answer_callback_query(call.id, app.texts[lang]['in_progress'])
+        return
+
+    running_jobs.add(job_key)
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        await handler(call, lang)
+        outcome = 'ok'
+    finally:
+        running_jobs.discard(job_key)
+        seconds = time.perf_counter() - started
+        CALLBACK_SECONDS.observe(seconds, action=action)
+        CALLBACKS.inc(action=action, outcome=outcome)
+        log_event('callback_done', action=action, outcome=outcome, ms=round(seconds * 1000))
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_query(call):
+    chat_id = call.message.chat.id
+    # Each update is handled in its own task, so the ID stays with this callback
+    new_request_id()
+    log_event('callback', data=call.data, chat_id=chat_id)
+
+    if call.data.startswith("lang_"):
+        new_lang = call.data.split("_")[1]
+        await set_chat_language(chat_id, new_lang)
+        await outbox.answer_callback_query(call.id, app.texts[new_lang]['language_set'].format(app.language_full[new_lang]))
+        await outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=app.texts[new_lang]['welcome'],
+            reply_markup=app.create_crypto_keyboard()
+        )
+        return
+
+    lang = await chat_language(chat_id)
+
+    if call.data.startswith("coin_"):
+        coin = app.coin_from_callback(call.data.split("_")[1])
+        if coin is None:
+            await outbox.answer_callback_query(call.id, "❌ Sorry, this coin is not available", show_alert=True)
+            return
+        clean_coin_name = coin.name
+
+        await outbox.answer_callback_query(
+            call.id,
+            f"🎯 Selected: {clean_coin_name}",
+            show_alert=False
+        )
+
+        await outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=app.texts[lang]['selected'].format(clean_coin_name),
+            reply_markup=app.create_timeframe_keyboard(coin.id, lang),
+            parse_mode='HTML'
+        )
+
+    elif call.data.startswith(("tf_", "timeframe_")):
+        await run_slow_job(call, handle_timeframe, lang, 'chart')
+
+    elif call.data.startswith("ai_"):
+        await run_slow_job(call, handle_ai, lang, 'ai')
+
+    elif call.data.startswith("coins_page_"):
+        await outbox.answer_callback_query(call.id)
+        try:
+            await outbox.edit_message_reply_markup(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                reply_markup=app.create_crypto_keyboard(int(call.data.rsplit("_", 1)[1]))
+            )
+        except ApiTelegramException:
+            # Tapping the current page number leaves the markup unchanged
+            pass
+
+    elif call.data == "show_coins":
+        await outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=app.texts[lang]['available_coins'],
+            reply_markup=app.create_crypto_keyboard()
+        )
+
+    elif call.data == "show_donation":
+        await outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=app.texts[lang]['donation_thanks'],
+            reply_markup=app.create_donation_keyboard(),
+            parse_mode='HTML'
+        )
+
+    elif call.data.startswith("donate_"):
+        star_amount = int(call.data.split("_")[1])
+
+        try:
+            prices = [types.LabeledPrice(label=f"{star_amount} Telegram Stars", amount=star_amount)]
+
+            await outbox.send_invoice(
+                chat_id=call.message.chat.id,
+                title="Support Crypto Tracker Bot",
+                description=f"Thank you for supporting our bot with {star_amount} Telegram Stars! Your contribution helps us maintain and improve the service.",
+                invoice_payload=f"donate_{star_amount}_stars",
+                provider_token="",  # Empty for Telegram Stars
+                currency="XTR",  # Telegram Stars currency code
+                prices=prices,
+                start_parameter="donate"
+            )
+
+            await outbox.answer_callback_query(
+                call.id,
+                f"⭐ Payment request sent for {star_amount} stars!",
+                show_alert=False
+            )
+
+        except Exception as e:
+            log_error('invoice', e, stars=star_amount)
+            await outbox.answer_callback_query(
+                call.id,
+                "❌ Sorry, there was an error processing your donation request.",
+                show_alert=True
+            )
+
+@bot.message_handler(commands=['coins'])
+async def show_coins(message):
+    chat_id = message.chat.id
+    lang = await chat_language(chat_id)
+    await outbox.reply_to(
+        message,
+        app.texts[lang]['available_coins'],
+        reply_markup=app.create_crypto_keyboard()
+    )
+
+@bot.pre_checkout_query_handler(func=lambda query: True)
+async def checkout(pre_checkout_query):
+    await outbox.answer_pre_checkout_query(
+        pre_checkout_query.id,
+        ok=True,
+        error_message="Something went wrong. Please try again later."
+    )
+
+@bot.message_handler(content_types=['successful_payment'])
+async def got_payment(message):
+    chat_id = message.chat.id
+    lang = await chat_language(chat_id)
+
+    await outbox.send_message(
+        chat_id,
+        app.texts[lang]['donation_success'],
+        reply_markup=app.create_main_menu_keyboard(lang),
+        parse_mode='HTML'
+    )
+
+@bot.message_handler(func=lambda message: True)
+async def handle_text(message):
+    chat_id = message.chat.id
+    lang = await chat_language(chat_id)
+    await outbox.reply_to(
+        message,
+        app.texts[lang]['handle_text'],
+        reply_markup=app.create_crypto_keyboard()
+    )
+
+async def main():
+    app.start_process_renderer()
+    # The bulk ticker refresh is a single request every few seconds, a thread is fine
+    app.ticker_snapshot.start()
+    app.start_exchange_info_refresh()
+    app.start_metrics_server()
+    try:
+        await bot.remove_webhook()
+        await bot.infinity_polling()
+    finally:
+        await binance.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""Cost of preparing Gemini's input in the AI modes.
+
+Latency is the local work before the request is sent: rendering and decoding
+three PNG charts, rendering them as raster images (separately or as one
+composite), or summarising the three kline frames. Tokens are estimated
+offline (Gemini bills 258 tokens per 768x768 image tile, text at roughly four
+characters a token); with --count-tokens and GEMINI_API_KEY set they are
+counted by the API instead.
+
+Usage: python benchmarks/ai_input_benchmark.py [runs] [--count-tokens]
+"""
+import math
+import os
+import sys
+import warnings
+
+from common import CHART_SIZES, measure, print_table, synthetic_klines
+
+warnings.filterwarnings('ignore', category=FutureWarning)
+
+from PIL import Image
+
+import bot
+from charts import composite_image, get_profile, render_candlestick
+from features import market_summary
+
+IMAGE_TILE = 768
+TOKENS_PER_TILE = 258
+CHARS_PER_TOKEN = 4
+
+
+def image_contents(frames):
+    images = []
+    for timeframe, (interval, df) in frames.items():
+        image = Image.open(render_candlestick(df, "Bitcoin (BTC)", timeframe, interval))
+        image.load()
+        images.append(image)
+    return [bot.build_ai_prompt("Bitcoin (BTC)", 'en'), *images]
+
+
+def raster_images(frames):
+    return [
+        render_candlestick(df, "Bitcoin (BTC)", timeframe, interval, get_profile('ai'))
+        for timeframe, (interval, df) in frames.items()
+    ]
+
+
+def raster_contents(frames):
+    return [bot.build_ai_prompt("Bitcoin (BTC)", 'en'), *raster_images(frames)]
+
+
+def composite_contents(frames):
+    return [bot.build_ai_prompt("Bitcoin (BTC)", 'en', composite=True), composite_image(raster_images(frames))]
+
+
+def feature_contents(frames):
+    return [bot.build_ai_prompt("Bitcoin (BTC)", 'en', market_summary(frames))]
+
+
+def estimate_tokens(contents):
+    tokens = 0
+    for part in contents:
+        if isinstance(part, str):
+            tokens += math.ceil(len(part) / CHARS_PER_TOKEN)
+        elif max(part.size) <= 384:
+            tokens += TOKENS_PER_TILE
+        else:
+            tiles = math.ceil(part.width / IMAGE_TILE) * math.ceil(part.height / IMAGE_TILE)
+            tokens += tiles * TOKENS_PER_TILE
+    return tokens
+
+
+def count_tokens(contents):
+    model = bot.genai.GenerativeModel('gemini-2.5-flash')
+    return model.count_tokens(contents).total_tokens
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    runs = int(args[0]) if args else 10
+    exact = '--count-tokens' in sys.argv and os.environ.get("GEMINI_API_KEY")
+
+    frames = {
+        timeframe: (interval, synthetic_klines(candles, interval))
+        for timeframe, interval, candles in CHART_SIZES
+    }
+
+    rows = []
+    modes = (
+        ('images', image_contents),
+        ('raster', raster_contents),
+        ('raster composite', composite_contents),
+        ('features', feature_contents),
+    )
+    for mode, build in modes:
+        seconds, peak = measure(lambda: build(frames), runs)
+        contents = build(frames)
+        rows.append((
+            mode,
+            f"{seconds * 1000:.1f}",
+            f"{peak / 1e6:.1f}",
+            len(contents) - 1,
+            count_tokens(contents) if exact else f"~{estimate_tokens(contents)}",
+        ))
+
+    print_table(("mode", "prepare ms", "peak MB", "images", "input tokens"), rows)
+
+
+if __name__ == '__main__':
+    main()
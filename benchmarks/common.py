@@ -0,0 +1,69 @@
+"""Shared helpers for the offline benchmarks in this directory"""
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# Let the benchmarks import the bot's modules when run as scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# (timeframe, interval, candles) as requested by the bot
+CHART_SIZES = [
+    ('1h', '1m', 60),
+    ('1w', '1h', 168),
+    ('1m', '1h', 720),
+]
+
+
+def synthetic_klines(n, interval='1h', seed=0, start_price=30000.0):
+    """Random-walk kline DataFrame shaped like bot.klines_to_frame output"""
+    rng = np.random.default_rng(seed)
+    step = pd.Timedelta(minutes=1) if interval.endswith('m') else pd.Timedelta(hours=1)
+
+    close = start_price * np.exp(np.cumsum(rng.normal(0, 0.004, n)))
+    open_ = np.concatenate([[start_price], close[:-1]])
+    spread = np.abs(rng.normal(0, 0.003, n)) * close
+    high = np.maximum(open_, close) + spread
+    low = np.minimum(open_, close) - spread
+    volume = rng.gamma(2.0, 50.0, n)
+
+    return pd.DataFrame({
+        'open_time': pd.date_range('2024-01-01', periods=n, freq=step),
+        'open': open_,
+        'high': high,
+        'low': low,
+        'close': close,
+        'volume': volume,
+    })
+
+
+def measure(fn, runs=10, warmup=1):
+    """Run `fn` and return (median seconds, peak traced bytes of one run)"""
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return statistics.median(samples), peak
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(x)) for x in col) for col in zip(headers, *rows)]
+    line = "  ".join(f"{{:<{w}}}" for w in widths)
+    print(line.format(*headers))
+    print(line.format(*("-" * w for w in widths)))
+    for row in rows:
+        print(line.format(*row))
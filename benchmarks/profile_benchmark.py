@@ -0,0 +1,38 @@
+"""Upload size and encode cost of each chart output profile.
+
+Usage: python benchmarks/profile_benchmark.py [runs]
+"""
+import sys
+
+from common import measure, print_table, synthetic_klines
+
+from charts import OUTPUT_PROFILES, encode_figure, frame_arrays, templates
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    arrays = frame_arrays(synthetic_klines(720, '1h'))
+
+    rows = []
+    for profile in OUTPUT_PROFILES.values():
+        template = templates.get('1m', '1h', profile.figsize, profile.dpi)
+        template.update(*arrays, "Bitcoin (BTC)")
+        # Every encode draws the figure again, so this is draw + encode time
+        encode_time, _ = measure(lambda: encode_figure(template.fig, profile), runs)
+        output = encode_figure(template.fig, profile)
+        # Raster profiles are never uploaded on their own, count their raw pixels
+        size = len(output.tobytes() if profile.format == 'raster' else output.getvalue())
+        width, height = (round(x * profile.dpi) for x in profile.figsize)
+        rows.append((
+            profile.name,
+            f"{width}x{height}",
+            profile.format,
+            f"{size / 1024:.1f}",
+            f"{encode_time * 1000:.1f}",
+        ))
+
+    print_table(("profile", "pixels", "format", "KB", "draw+encode ms"), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Compare the collection-based renderer in charts.py with the old bar-based one.
+
+Both build a new figure per chart; the template cache charts.py uses on top
+of that is measured by template_benchmark.py.
+
+Usage: python benchmarks/render_benchmark.py [runs]
+"""
+import sys
+from io import BytesIO
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.dates import DateFormatter
+
+from common import CHART_SIZES, measure, print_table, synthetic_klines
+
+from charts import frame_arrays, render_arrays
+
+
+def legacy_plot_candlestick(df, coin_name, timeframe, interval):
+    """The original pyplot implementation, six ax.bar calls per chart"""
+    if interval.endswith('m'):
+        min_interval = int(interval[:-1])
+    elif interval.endswith('h'):
+        min_interval = int(interval[:-1]) * 60
+    else:
+        min_interval = 1
+
+    width = (min_interval / 1440.0) * 0.8
+    width2 = width / 10.0
+
+    up = df[df.close >= df.open]
+    down = df[df.close < df.open]
+
+    col_up = 'green'
+    col_down = 'red'
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, gridspec_kw={'height_ratios': [3, 1]}, figsize=(10, 8), sharex=True)
+
+    ax1.bar(up['open_time'], up['close'] - up['open'], width, bottom=up['open'], color=col_up)
+    ax1.bar(down['open_time'], down['open'] - down['close'], width, bottom=down['close'], color=col_down)
+
+    ax1.bar(up['open_time'], up['high'] - up['close'], width2, bottom=up['close'], color=col_up)
+    ax1.bar(up['open_time'], up['open'] - up['low'], width2, bottom=up['low'], color=col_up)
+    ax1.bar(down['open_time'], down['high'] - down['open'], width2, bottom=down['open'], color=col_down)
+    ax1.bar(down['open_time'], down['close'] - down['low'], width2, bottom=down['low'], color=col_down)
+
+    if len(df) >= 20:
+        sma = df['close'].rolling(window=20).mean()
+        ax1.plot(df['open_time'], sma, color='orange', label='SMA 20')
+        ax1.legend()
+
+    ax1.set_title(f"{coin_name} Candlestick Chart ({timeframe})")
+    ax1.set_ylabel("Price (USD)")
+    ax1.grid(True)
+
+    ax2.bar(df['open_time'], df['volume'], width, color=[col_up if c >= o else col_down for o, c in zip(df['open'], df['close'])])
+    ax2.set_ylabel("Volume")
+    ax2.grid(True)
+
+    ax2.xaxis.set_major_formatter(DateFormatter('%Y-%m-%d %H:%M'))
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=100)
+    buf.seek(0)
+    plt.close(fig)
+
+    return buf
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    rows = []
+    for timeframe, interval, candles in CHART_SIZES:
+        df = synthetic_klines(candles, interval)
+        legacy_time, legacy_peak = measure(lambda: legacy_plot_candlestick(df, "Bitcoin (BTC)", timeframe, interval), runs)
+        # render_candlestick would go through the template cache, render_arrays is the plain renderer
+        new_time, new_peak = measure(lambda: render_arrays(*frame_arrays(df), "Bitcoin (BTC)", timeframe, interval), runs)
+        rows.append((
+            timeframe,
+            candles,
+            f"{legacy_time * 1000:.1f}",
+            f"{new_time * 1000:.1f}",
+            f"{legacy_time / new_time:.2f}x",
+            f"{legacy_peak / 1e6:.1f}",
+            f"{new_peak / 1e6:.1f}",
+        ))
+
+    print_table(
+        ("timeframe", "candles", "legacy ms", "charts ms", "speedup", "legacy peak MB", "charts peak MB"),
+        rows
+    )
+
+
+if __name__ == '__main__':
+    main()
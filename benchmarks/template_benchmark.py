@@ -0,0 +1,34 @@
+"""Per-render saving of refilling a cached figure template over building a new figure.
+
+Usage: python benchmarks/template_benchmark.py [runs]
+"""
+import sys
+
+from common import CHART_SIZES, measure, print_table, synthetic_klines
+
+from charts import frame_arrays, render_arrays, render_template
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    rows = []
+    for timeframe, interval, candles in CHART_SIZES:
+        arrays = frame_arrays(synthetic_klines(candles, interval))
+        fresh_time, _ = measure(lambda: render_arrays(*arrays, "Bitcoin (BTC)", timeframe, interval), runs)
+        # The warmup run builds the template, the timed runs only refill it
+        template_time, _ = measure(lambda: render_template(*arrays, "Bitcoin (BTC)", timeframe, interval), runs)
+        rows.append((
+            timeframe,
+            candles,
+            f"{fresh_time * 1000:.1f}",
+            f"{template_time * 1000:.1f}",
+            f"{(fresh_time - template_time) * 1000:.1f}",
+            f"{fresh_time / template_time:.2f}x",
+        ))
+
+    print_table(("timeframe", "candles", "new figure ms", "template ms", "saved ms", "speedup"), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Offline check and response time of the webhook server.
+
+Recorded updates are POSTed to a server from webhook.create_server on a free
+local port, with a dispatcher that records them instead of running the
+handlers, so nothing reaches Telegram. Checks that updates are decoded and
+answered with 200, that a wrong secret gets 403 without spoiling the next
+update on the same connection and that a full backlog gets 503, then times
+the 200 answers.
+
+Usage: python benchmarks/webhook_benchmark.py [runs]
+"""
+import http.client
+import json
+import sys
+import threading
+import warnings
+
+from common import measure, print_table
+
+warnings.filterwarnings('ignore', category=FutureWarning)
+
+import webhook
+
+SECRET = 'benchmark-secret'
+
+# A button press as Telegram posts it
+RECORDED_UPDATE = {
+    'update_id': 100000001,
+    'callback_query': {
+        'id': '4382bfdwdsb323b2d9',
+        'from': {'id': 1111111, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'},
+        'message': {
+            'message_id': 42,
+            'from': {'id': 2222222, 'is_bot': True, 'first_name': 'Crypto Tracker Bot'},
+            'chat': {'id': 1111111, 'type': 'private', 'first_name': 'Test'},
+            'date': 1700000000,
+            'text': 'Choose a coin',
+        },
+        'chat_instance': '-1234567890',
+        'data': 'tf_0_1h',
+    },
+}
+
+
+class Recorder:
+    """Process function for UpdateDispatcher that keeps the updates, blocking while `gate` is closed"""
+
+    def __init__(self):
+        self.updates = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.done = threading.Semaphore(0)
+
+    def __call__(self, updates):
+        self.gate.wait()
+        self.updates.extend(updates)
+        self.done.release()
+
+
+def post(port, body, secret=SECRET, connection=None):
+    """POST an update and return the status, on `connection` if given (left open) or a new one"""
+    own = connection is None
+    if own:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request('POST', webhook.WEBHOOK_PATH, body, {
+            'Content-Type': 'application/json',
+            webhook.SECRET_HEADER: secret,
+        })
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        if own:
+            connection.close()
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    body = json.dumps(RECORDED_UPDATE).encode()
+
+    recorder = Recorder()
+    dispatcher = webhook.UpdateDispatcher(recorder, workers=2, max_pending=4)
+    server = webhook.create_server(host='127.0.0.1', port=0, secret=SECRET, dispatcher=dispatcher)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        assert post(port, body) == 200
+        recorder.done.acquire(timeout=5)
+        update = recorder.updates[0]
+        assert update.update_id == RECORDED_UPDATE['update_id']
+        assert update.callback_query.data == 'tf_0_1h'
+        assert update.callback_query.message.chat.id == 1111111
+
+        assert post(port, body, secret='wrong') == 403
+        assert post(port, b'not json') == 400
+
+        # A refused update's unread body must not turn into the next request on a kept-alive connection
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        try:
+            assert post(port, body, secret='wrong', connection=connection) == 403
+            assert post(port, body, connection=connection) == 200
+        finally:
+            connection.close()
+        recorder.done.acquire(timeout=5)
+        assert recorder.updates[-1].update_id == RECORDED_UPDATE['update_id']
+
+        # Hold the handlers so the backlog fills up to max_pending
+        recorder.gate.clear()
+        statuses = [post(port, body) for _ in range(dispatcher.max_pending + 1)]
+        assert statuses == [200] * dispatcher.max_pending + [503], statuses
+        recorder.gate.set()
+        for _ in range(dispatcher.max_pending):
+            recorder.done.acquire(timeout=5)
+
+        reply_time, _ = measure(lambda: post(port, body), runs)
+        for _ in range(runs + 2):
+            recorder.done.acquire(timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+        dispatcher.shutdown()
+
+    print("Recorded update: 200, wrong secret: 403, bad body: 400, 403 then 200 on one connection, full backlog: 503")
+    print_table(("requests", "median reply ms"), [(runs, f"{reply_time * 1000:.2f}")])
+
+
+if __name__ == '__main__':
+    main()
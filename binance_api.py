@@ -0,0 +1,516 @@
+"""Binance REST helpers shared by the bot"""
+import asyncio
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import REGISTRY, log_error
+
+BASE_URL = "https://api.binance.com"
+
+# Status codes worth another attempt; 429/418 are left to the caller to back off on
+RETRY_STATUSES = {500, 502, 503, 504}
+
+# 429 warns that the weight limit was hit, 418 is the IP ban that follows ignoring it
+RATE_LIMIT_STATUSES = {418, 429}
+
+USED_WEIGHT_HEADER = 'X-MBX-USED-WEIGHT-1M'
+# Weight Binance allows one IP per minute, whatever share of it a process is given
+IP_WEIGHT_LIMIT = 6000
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'botrader_binance_request_seconds',
+    'Binance request latency including retries, by endpoint',
+    labels=('endpoint',)
+)
+REQUESTS = REGISTRY.counter(
+    'botrader_binance_requests_total',
+    'Binance requests by endpoint and final HTTP status (none for connection errors)',
+    labels=('endpoint', 'status')
+)
+
+# Request priorities: a user waiting on a chart comes before background refreshes
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class BinanceError(Exception):
+    """A Binance request that failed after all retries"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimited(BinanceError):
+    """A request shed by the WeightLimiter instead of risking Binance's limit"""
+
+
+def klines_weight(limit):
+    """Request weight Binance charges for /api/v3/klines with the given limit"""
+    if limit < 100:
+        return 1
+    if limit < 500:
+        return 2
+    if limit <= 1000:
+        return 5
+    return 10
+
+
+def ticker_weight(params):
+    """Request weight of /api/v3/ticker/24hr for one symbol, a symbols list or every symbol"""
+    if params and 'symbol' in params:
+        return 2
+    if params and 'symbols' in params:
+        count = len(json.loads(params['symbols']))
+        if count <= 20:
+            return 2
+        if count <= 100:
+            return 40
+    return 80
+
+
+def request_weight(path, params=None):
+    """Request weight Binance charges for a GET, 1 for endpoints not listed here"""
+    if path == '/api/v3/klines':
+        return klines_weight(int(params.get('limit', 500)))
+    if path == '/api/v3/ticker/24hr':
+        return ticker_weight(params)
+    if path == '/api/v3/exchangeInfo':
+        return 20
+    return 1
+
+
+class WeightLimiter:
+    """Token bucket over Binance's per-minute request weight, shared by all clients of a process.
+
+    The bucket holds up to `limit` weight and refills at `limit` per minute.
+    Every response's X-MBX-USED-WEIGHT-1M header tells how much weight the IP
+    has used this minute, including other processes on it. Against the IP's
+    `ip_limit` that leaves some share of the minute unused, and the bucket is
+    lowered to the same share of `limit` whenever it is more optimistic, so a
+    process given part of the IP's limit is not starved by the others. Background
+    calls leave `reserve` of the budget to interactive ones and are shed
+    rather than queued; interactive calls wait up to `max_wait` seconds, ahead
+    of any background call. A 429 or 418 stops every call until its
+    Retry-After has passed.
+    """
+
+    def __init__(self, limit=IP_WEIGHT_LIMIT, reserve=0.2, max_wait=5.0, ip_limit=IP_WEIGHT_LIMIT):
+        self.limit = limit
+        self.ip_limit = ip_limit
+        self.reserve = limit * reserve
+        self.max_wait = max_wait
+        self.tokens = float(limit)
+        self.used_weight = None  # last X-MBX-USED-WEIGHT-1M seen
+        self.blocked_until = 0
+        self.waiting = 0  # interactive calls queued for weight
+        self.shed = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, weight, priority=INTERACTIVE):
+        """Take `weight` from the budget, sleeping for it if allowed, or raise RateLimited"""
+        deadline = self._enter(priority)
+        try:
+            while True:
+                delay = self._take(weight, priority, deadline)
+                if not delay:
+                    return
+                time.sleep(delay)
+        finally:
+            self._leave(priority)
+
+    async def acquire_async(self, weight, priority=INTERACTIVE):
+        """acquire() for coroutines, waits without blocking the event loop"""
+        deadline = self._enter(priority)
+        try:
+            while True:
+                delay = self._take(weight, priority, deadline)
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+        finally:
+            self._leave(priority)
+
+    def observe(self, used_weight):
+        """Align the bucket with the weight Binance reports as used this minute"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.used_weight = used_weight
+            left = max(self.ip_limit - used_weight, 0) / self.ip_limit
+            self.tokens = min(self.tokens, self.limit * left)
+
+    def penalize(self, retry_after):
+        """Stop all calls for `retry_after` seconds after a 429 or 418"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.tokens = 0
+
+    def budget(self):
+        """Current state for monitoring: weight available now, last reported usage and so on"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'limit': self.limit,
+                'available': max(int(self.tokens), 0),
+                'used_weight': self.used_weight,
+                'blocked_seconds': max(self.blocked_until - now, 0),
+                'waiting': self.waiting,
+                'shed_interactive': self.shed[INTERACTIVE],
+                'shed_background': self.shed[BACKGROUND],
+            }
+
+    def _enter(self, priority):
+        if priority == INTERACTIVE:
+            with self._lock:
+                self.waiting += 1
+        return time.monotonic() + self.max_wait
+
+    def _leave(self, priority):
+        if priority == INTERACTIVE:
+            with self._lock:
+                self.waiting -= 1
+
+    def _take(self, weight, priority, deadline):
+        """Take the weight and return 0, or return how long to sleep before trying again"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                delay = self.blocked_until - now
+            elif priority == BACKGROUND and self.waiting:
+                delay = None
+            else:
+                needed = weight + (self.reserve if priority == BACKGROUND else 0)
+                if self.tokens >= needed:
+                    self.tokens -= weight
+                    return 0
+                delay = (needed - self.tokens) * 60 / self.limit
+
+            if priority == BACKGROUND or delay is None or now + delay > deadline:
+                self.shed[priority] += 1
+                raise RateLimited(f"Binance request weight budget exhausted, {weight} weight shed")
+            # Wake up now and then, a header or a refill may free weight sooner
+            return min(delay, 0.25)
+
+    def _refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self._updated) * self.limit / 60)
+        self._updated = now
+
+
+def record_request(path, status, started):
+    """Add a finished request to the metrics"""
+    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=path)
+    REQUESTS.inc(endpoint=path, status=status or 'none')
+
+
+def observe_response(limiter, status, headers):
+    """Feed a response's used weight, and any 429/418 with its Retry-After, to the limiter"""
+    if limiter is None:
+        return
+    used = headers.get(USED_WEIGHT_HEADER)
+    if used is not None:
+        limiter.observe(int(used))
+    if status in RATE_LIMIT_STATUSES:
+        try:
+            limiter.penalize(float(headers.get('Retry-After', 60)))
+        except ValueError:
+            limiter.penalize(60)
+
+
+class BinanceClient:
+    """Pooled keep-alive HTTP client for the Binance REST API.
+
+    One `requests.Session` is shared by every worker thread so TCP and TLS
+    connections are reused across charts. Connection errors and 5xx responses
+    are retried a bounded number of times with full-jitter exponential backoff.
+    With a `limiter`, every attempt first takes its request weight from it.
+    """
+
+    def __init__(self, base_url=BASE_URL, pool_size=10, timeout=10, retries=2, backoff=0.25, limiter=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = limiter
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, path, params=None, priority=INTERACTIVE):
+        """GET a Binance endpoint and return the decoded JSON body"""
+        url = self.base_url + path
+        weight = request_weight(path, params)
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            attempt += 1
+            status = None
+            if self.limiter is not None:
+                self.limiter.acquire(weight, priority)
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                status = response.status_code
+                observe_response(self.limiter, status, response.headers)
+                if status in RETRY_STATUSES and attempt <= self.retries:
+                    raise BinanceError(f"HTTP {status}", status)
+                response.raise_for_status()
+                data = response.json()
+                record_request(path, status, started)
+                return data
+            except (requests.ConnectionError, requests.Timeout, BinanceError) as e:
+                if attempt > self.retries:
+                    record_request(path, status, started)
+                    raise BinanceError(f"GET {path} failed after {attempt} attempts: {e}", status) from e
+                # Full jitter keeps retries from many threads from lining up
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            except requests.RequestException as e:
+                record_request(path, status, started)
+                raise BinanceError(f"GET {path} failed: {e}", status) from e
+
+    def klines(self, symbol, interval, limit):
+        return self.get('/api/v3/klines', {'symbol': symbol, 'interval': interval, 'limit': limit})
+
+    def ticker_24hr(self, symbol):
+        return self.get('/api/v3/ticker/24hr', {'symbol': symbol})
+
+    def exchange_info(self):
+        return self.get('/api/v3/exchangeInfo', priority=BACKGROUND)
+
+
+class AsyncBinanceClient:
+    """Asyncio counterpart of BinanceClient built on a pooled aiohttp session"""
+
+    def __init__(self, base_url=BASE_URL, pool_size=100, timeout=10, retries=2, backoff=0.25, limiter=None):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.limiter = limiter
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+
+    async def _get_session(self):
+        # aiohttp is only needed by the asyncio engine
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'},
+                auto_decompress=True,
+            )
+        return self._session
+
+    async def get(self, path, params=None, priority=INTERACTIVE):
+        """GET a Binance endpoint and return the decoded JSON body"""
+        import aiohttp
+
+        session = await self._get_session()
+        url = self.base_url + path
+        weight = request_weight(path, params)
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            attempt += 1
+            status = None
+            if self.limiter is not None:
+                await self.limiter.acquire_async(weight, priority)
+            try:
+                async with session.get(url, params=params) as response:
+                    status = response.status
+                    observe_response(self.limiter, status, response.headers)
+                    if status in RETRY_STATUSES and attempt <= self.retries:
+                        raise BinanceError(f"HTTP {status}", status)
+                    response.raise_for_status()
+                    data = await response.json()
+                record_request(path, status, started)
+                return data
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, BinanceError) as e:
+                if attempt > self.retries:
+                    record_request(path, status, started)
+                    raise BinanceError(f"GET {path} failed after {attempt} attempts: {e}", status) from e
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            except aiohttp.ClientError as e:
+                record_request(path, status, started)
+                raise BinanceError(f"GET {path} failed: {e}", status) from e
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def klines(self, symbol, interval, limit):
+        return await self.get('/api/v3/klines', {'symbol': symbol, 'interval': interval, 'limit': limit})
+
+    async def ticker_24hr(self, symbol):
+        return await self.get('/api/v3/ticker/24hr', {'symbol': symbol})
+
+
+class TickerSnapshot:
+    """24h price stats for a fixed set of symbols, refreshed in the background.
+
+    Every symbol is loaded with one bulk /api/v3/ticker/24hr request per refresh
+    and readers only look at the last stored snapshot, so they never wait on
+    the network.
+    """
+
+    def __init__(self, client, symbols, interval=5, on_refresh=None):
+        self.client = client
+        self.symbols = sorted(set(symbols))
+        self.interval = interval
+        self.on_refresh = on_refresh  # on_refresh(prices, updated_at) after every refresh
+        self.updated_at = 0
+        self._prices = {}  # symbol -> (last_price, price_change_percent)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def loaded(self):
+        return self.updated_at > 0
+
+    def get(self, symbol):
+        """Return (last_price, price_change_percent) or None if the symbol is unknown"""
+        return self._prices.get(symbol)
+
+    def refresh(self):
+        symbols = json.dumps(self.symbols, separators=(',', ':'))
+        try:
+            data = self.client.get('/api/v3/ticker/24hr', {'symbols': symbols}, priority=BACKGROUND)
+        except BinanceError as e:
+            if e.status != 400:
+                raise
+            # A single unknown symbol fails the whole request, so load every
+            # ticker once and drop the symbols Binance does not list
+            wanted = set(self.symbols)
+            data = [t for t in self.client.get('/api/v3/ticker/24hr', priority=BACKGROUND) if t['symbol'] in wanted]
+            self.symbols = sorted(t['symbol'] for t in data)
+
+        # Swap the whole dict so readers never see a half-updated snapshot
+        self._prices = {
+            t['symbol']: (float(t['lastPrice']), float(t['priceChangePercent']))
+            for t in data
+        }
+        self.updated_at = time.time()
+        if self.on_refresh is not None:
+            self.on_refresh(self._prices, self.updated_at)
+
+    def start(self):
+        """Load the first snapshot and keep refreshing it on a daemon thread"""
+        try:
+            self.refresh()
+        except Exception as e:
+            log_error('ticker_snapshot', e)
+        self._thread = threading.Thread(target=self._run, name='ticker-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                log_error('ticker_snapshot', e)
+
+
+class SharedTickers:
+    """A ticker snapshot in shared memory, refreshed by one process and read by others.
+
+    cluster.py's intake process runs the only TickerSnapshot and publishes
+    every refresh here, so the bulk ticker weight does not grow with the
+    number of workers. Readers get TickerSnapshot's `loaded`, `updated_at`
+    and `get`.
+    """
+
+    def __init__(self, symbols, context=multiprocessing):
+        self.symbols = sorted(set(symbols))
+        self._index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        # updated_at, then last price and 24h change per symbol, NaN until known
+        self._values = context.Array('d', [0.0] + [math.nan] * (2 * len(self.symbols)))
+
+    @property
+    def updated_at(self):
+        return self._values[0]
+
+    @property
+    def loaded(self):
+        return self.updated_at > 0
+
+    def get(self, symbol):
+        """Return (last_price, price_change_percent) or None if the symbol is unknown"""
+        i = self._index.get(symbol)
+        if i is None:
+            return None
+        with self._values.get_lock():
+            price, change = self._values[1 + 2 * i:3 + 2 * i]
+        return None if math.isnan(price) else (price, change)
+
+    def publish(self, prices, updated_at):
+        """Store a refreshed snapshot, TickerSnapshot's on_refresh"""
+        values = [updated_at]
+        for symbol in self.symbols:
+            values.extend(prices.get(symbol, (math.nan, math.nan)))
+        with self._values.get_lock():
+            self._values[:] = values
+
+    def start(self):
+        """Nothing to start, the publishing process refreshes it"""
+
+    def stop(self):
+        pass
+
+
+class KlineFetchPlanner:
+    """Serve several kline views with one upstream fetch per (symbol, interval).
+
+    A view is a (symbol, interval, limit) tuple. Views that share a symbol and
+    interval are the tail of the largest one, so only that one is fetched and
+    the others are sliced from it locally.
+    """
+
+    @staticmethod
+    def plan(views):
+        """Return {(symbol, interval): limit} covering every view with the fewest fetches"""
+        plan = {}
+        for symbol, interval, limit in views:
+            key = (symbol, interval)
+            plan[key] = max(plan.get(key, 0), limit)
+        return plan
+
+    @staticmethod
+    def assemble(views, plan, frames):
+        """Cut every view out of the {(symbol, interval): DataFrame} fetched for `plan`.
+
+        Returns {view: DataFrame or None} and the calls and weight the merge saved.
+        """
+        results = {}
+        for view in views:
+            symbol, interval, limit = view
+            df = frames[(symbol, interval)]
+            if df is not None and plan[(symbol, interval)] != limit:
+                df = df.tail(limit).reset_index(drop=True)
+            results[view] = df
+
+        calls_saved = len(views) - len(plan)
+        weight_saved = (
+            sum(klines_weight(limit) for _, _, limit in views)
+            - sum(klines_weight(limit) for limit in plan.values())
+        )
+        return results, calls_saved, weight_saved
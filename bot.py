@@ -1,22 +1,31 @@
 import telebot
 from telebot import apihelper
 from telebot import types
+import contextvars
+import functools
 import logging
 import os
 from dotenv import load_dotenv
 import time
 from PIL import Image
 from io import BytesIO
-import requests
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend to avoid GUI threading issues
-import matplotlib.pyplot as plt
 import pandas as pd
-from matplotlib.dates import DateFormatter
 import google.generativeai as genai  # Make sure to install: pip install google-generativeai
 import json
+import html
+import re
 from datetime import datetime
 from urllib.parse import quote
+from binance_api import BinanceClient, KlineFetchPlanner, TickerSnapshot, WeightLimiter
+from cache import ChartCache, FileIdCache, KlineCache, PersistentTTLCache, next_candle_close
+from features import market_summary
+from metrics import CALLBACK_SECONDS, CALLBACKS, REGISTRY, STAGE_SECONDS, log_error, log_event, new_request_id
+from metrics import start_server as start_metrics_server
+from charts import ProcessRenderer, composite_image, get_profile, render_candlestick
+from outbox import Outbox, SendQueue
+from preferences import open_store
+from symbols import CoinRegistry, load_exchange_info, refresh_in_background
+from workers import JOB_BUSY, JOB_DUPLICATE, ChatJobQueue, ParallelStage
 
 logger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
@@ -31,7 +40,78 @@ genai.configure(api_key=GEMINI_API_KEY)
 
 bot = telebot.TeleBot(API_TOKEN)
 
-user_languages = {}  # Store user languages {chat_id: 'en'/'fa'/'ar'}
+# Handlers queue their Telegram calls here instead of making them, see outbox.SendQueue
+send_queue = SendQueue(
+    rate=float(os.environ.get("TELEGRAM_RATE", 30)),
+    chat_rate=float(os.environ.get("TELEGRAM_CHAT_RATE", 1)),
+    chat_burst=int(os.environ.get("TELEGRAM_CHAT_BURST", 3)),
+    workers=int(os.environ.get("TELEGRAM_SEND_WORKERS", 8))
+)
+outbox = Outbox(bot, send_queue)
+
+# Per-chat settings such as the language, cached in memory and written to disk in batches;
+# the database is opened by the first handler that needs it
+preferences = open_store(
+    os.environ.get("PREFERENCES_BACKEND", "sqlite"),
+    os.environ.get("PREFERENCES_PATH", "data/preferences.db"),
+    flush_interval=float(os.environ.get("PREFERENCES_FLUSH_SECONDS", 1)),
+    max_chats=int(os.environ.get("PREFERENCES_CACHE_SIZE", 10000))
+)
+
+# Request weight budget shared by every Binance call of this process, see WeightLimiter
+binance_limiter = WeightLimiter(
+    limit=int(os.environ.get("BINANCE_WEIGHT_LIMIT", 6000)),
+    reserve=float(os.environ.get("BINANCE_WEIGHT_RESERVE", 0.2)),
+    max_wait=float(os.environ.get("BINANCE_WEIGHT_WAIT", 5))
+)
+
+# One pooled keep-alive connection set to Binance for all handler threads
+binance = BinanceClient(pool_size=int(os.environ.get("BINANCE_POOL_SIZE", 10)), limiter=binance_limiter)
+
+# Klines shared by every chat, kept until the candle they were fetched in closes
+kline_cache = KlineCache(max_entries=int(os.environ.get("KLINE_CACHE_SIZE", 256)))
+
+# Rendered PNGs keyed by (symbol, timeframe, last candle open time), bounded by total size
+chart_cache = ChartCache(max_bytes=int(os.environ.get("CHART_CACHE_BYTES", 32 * 1024 * 1024)))
+
+# Charts and AI analyses run here instead of on telebot's handler threads
+slow_jobs = ChatJobQueue(
+    {
+        'chart': int(os.environ.get("CHART_WORKERS", 4)),
+        'ai': int(os.environ.get("AI_WORKERS", 2)),
+    },
+    max_pending=int(os.environ.get("JOB_QUEUE_LIMIT", 32))
+)
+
+# The Binance calls of one request run side by side and share FETCH_DEADLINE seconds
+fetch_stage = ParallelStage('fetch', max_workers=int(os.environ.get("FETCH_WORKERS", 16)))
+FETCH_DEADLINE = float(os.environ.get("FETCH_DEADLINE", 8))
+
+# The three charts of an AI analysis render side by side
+render_stage = ParallelStage('render', max_workers=6)
+
+# Telegram file_ids of charts already uploaded, reused until their candle rolls over
+chart_file_ids = FileIdCache(max_entries=1024)
+
+# Parsed Gemini signals keyed by coin, language and hourly candle, kept across restarts
+ai_cache = PersistentTTLCache(
+    path=os.environ.get("AI_CACHE_PATH", "data/ai_cache.json") or None,
+    ttl=float(os.environ.get("AI_CACHE_TTL", 3600)),
+    max_entries=int(os.environ.get("AI_CACHE_SIZE", 512))
+)
+
+# What Gemini looks at: "images" of the three charts or a numeric "features" summary of them
+AI_INPUT = os.environ.get("AI_INPUT", "images")
+
+# Hand Gemini 640x512 images straight from the canvas instead of decoding the chart PNGs
+AI_RASTER = os.environ.get("AI_RASTER", "0") == "1"
+# Send the three charts as one image stacked top to bottom
+AI_COMPOSITE = os.environ.get("AI_COMPOSITE", "0") == "1"
+
+# Stream Gemini's answer into the processing message instead of waiting for all of it
+AI_STREAM = os.environ.get("AI_STREAM", "1") == "1"
+# Telegram allows roughly one edit per second per chat before answering 429
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get("AI_STREAM_EDIT_INTERVAL", 1.5))
 
 texts = {
     'en': {
@@ -54,6 +134,8 @@ texts = {
         'donation_thanks': "⭐ Thank you for your support!\n\n💝 Your donation helps us keep this bot running and improving.\n\nYou can support us with Telegram Stars:",
         'donation_success': "🎉 Thank you for your generous donation!\n\n💖 Your support means the world to us!",
         'donation_cancelled': "No problem! You can donate anytime by using /donate command.",
+        'busy': "⏳ The bot is busy right now.\n\nPlease try again in a moment.",
+        'in_progress': "⏳ Already working on it...",
     },
     'fa': {
         'select_language': "لطفاً زبان خود را انتخاب کنید:",
@@ -75,6 +157,8 @@ texts = {
         'donation_thanks': "⭐ از حمایت شما متشکریم!\n\n💝 کمک مالی شما به ما کمک می‌کند این ربات را فعال و بهتر نگه داریم.\n\nمی‌توانید با Telegram Stars از ما حمایت کنید:",
         'donation_success': "🎉 از کمک سخاوتمندانه شما متشکریم!\n\n💖 حمایت شما برای ما بسیار ارزشمند است!",
         'donation_cancelled': "مشکلی نیست! می‌توانید هر زمان با دستور /donate کمک کنید.",
+        'busy': "⏳ ربات در حال حاضر مشغول است.\n\nلطفاً چند لحظه دیگر امتحان کنید.",
+        'in_progress': "⏳ در حال انجام است...",
     },
     'ar': {
         'select_language': "يرجى اختيار لغتك:",
@@ -96,6 +180,8 @@ texts = {
         'donation_thanks': "⭐ شكرا لدعمك!\n\n💝 تبرعك يساعدنا في الحفاظ على هذا البوت وتحسينه.\n\nيمكنك دعمنا بنجوم تيليجرام:",
         'donation_success': "🎉 شكرا لتبرعك السخي!\n\n💖 دعمك يعني الكثير بالنسبة لنا!",
         'donation_cancelled': "لا مشكلة! يمكنك التبرع في أي وقت باستخدام الأمر /donate.",
+        'busy': "⏳ البوت مشغول حاليًا.\n\nيرجى المحاولة بعد لحظات.",
+        'in_progress': "⏳ جاري العمل على ذلك...",
     }
 }
 
@@ -139,7 +225,7 @@ BINANCE_SYMBOLS = {
     "Cronos (CRO)": "CROUSDT",
     "Kaspa (KAS)": "KASUSDT",
     "Quant (QNT)": "QNTUSDT",
-    "Render (RNDR)": "RNDRUSDT",
+    "Render (RENDER)": "RENDERUSDT",
     "Injective (INJ)": "INJUSDT",
     "Sui (SUI)": "SUIUSDT",
     "The Graph (GRT)": "GRTUSDT",
@@ -174,7 +260,7 @@ BINANCE_SYMBOLS = {
     "Arweave (AR)": "ARUSDT",
     "Basic Attention (BAT)": "BATUSDT",
     "Harmony (ONE)": "ONEUSDT",
-    "Celo (CELO)": "CELOUSD",
+    "Celo (CELO)": "CELOUSDT",
     "Ankr (ANKR)": "ANKRUSDT",
     "Fetch.ai (FET)": "FETUSDT",
     "Ocean Protocol (OCEAN)": "OCEANUSDT",
@@ -219,7 +305,7 @@ CRYPTO_COINS = [
     "ℏ Hedera (HBAR)", "∞ Internet Computer (ICP)", "🦄 Uniswap (UNI)", "🅰 Aptos (APT)",
     "🔵 Arbitrum (ARB)", "🔴 Optimism (OP)", "⭕ Near Protocol (NEAR)", "📚 Stacks (STX)",
     "⚔ Immutable (IMX)", "🔷 Cronos (CRO)", "💎 Kaspa (KAS)", "🔢 Quant (QNT)",
-    "🎨 Render (RNR)", "💉 Injective (INJ)", "🌊 Sui (SUI)", "📊 The Graph (GRT)",
+    "🎨 Render (RENDER)", "💉 Injective (INJ)", "🌊 Sui (SUI)", "📊 The Graph (GRT)",
     "θ Theta Network (THETA)", "🏛 Maker (MKR)", "⚡ Synthetix (SNX)", "👻 Aave (AAVE)",
     "📱 EOS (EOS)", "🎮 Axie Infinity (AXS)", "🏖 The Sandbox (SAND)", "🌐 Decentraland (MANA)",
     "🔷 Tezos (XTZ)", "🌊 Flow (FLOW)", "👻 Fantom (FTM)", "🔶 Kava (KAVA)",
@@ -238,120 +324,209 @@ CRYPTO_COINS = [
     "🔺 Convex Finance (CVX)", "💰 Yearn.finance (YFI)", "📊 UMA (UMA)", "📹 Livepeer (LPT)"
 ]
 
+# Small coin IDs for callback data, and the symbol, name and emoji behind each
+coins = CoinRegistry(CRYPTO_COINS, BINANCE_SYMBOLS)
+
+# Hide the coins Binance no longer trades, going by the exchangeInfo snapshot on disk
+listed_symbols, exchange_info_updated_at = load_exchange_info()
+if listed_symbols:
+    for coin in coins.prune(listed_symbols):
+        log_event('coin_pruned', coin=coin.name, symbol=coin.symbol)
+
+def start_exchange_info_refresh():
+    """Download a fresh exchangeInfo snapshot in the background if ours is missing or stale"""
+    refresh_in_background(binance, exchange_info_updated_at)
+
+def coin_from_callback(value):
+    """Coin from the ID in callback data, or from the name older messages still carry"""
+    if value.isdigit():
+        return coins.get(int(value))
+    return coins.by_name(value)
+
+# Klines requested for each chart timeframe
+TIMEFRAME_PARAMS = {
+    '1h': {'interval': '1m', 'limit': 60},
+    '1w': {'interval': '1h', 'limit': 168},
+    '1m': {'interval': '1h', 'limit': 720}
+}
+
 def get_binance_ohlc(symbol, interval, limit):
-    """Fetch OHLCV data from Binance API"""
-    url = f"https://api.binance.com/api/v3/klines?symbol={symbol}&interval={interval}&limit={limit}"
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+    """Fetch OHLCV data, served from the kline cache until the current candle closes"""
+    return kline_cache.get_or_fetch(
+        (symbol, interval, limit),
+        interval,
+        lambda: fetch_binance_ohlc(symbol, interval, limit)
+    )
+
+def klines_to_frame(data):
+    """Turn a raw /api/v3/klines response into an OHLCV DataFrame"""
+    with STAGE_SECONDS.time(stage='parse'):
         df = pd.DataFrame(data, columns=['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base', 'taker_buy_quote', 'ignore'])
         df['open_time'] = pd.to_datetime(df['open_time'], unit='ms')
         df[['open', 'high', 'low', 'close', 'volume']] = df[['open', 'high', 'low', 'close', 'volume']].astype(float)
-        return df
+    return df
+
+def fetch_binance_ohlc(symbol, interval, limit):
+    """Fetch OHLCV data from Binance API"""
+    try:
+        return klines_to_frame(binance.klines(symbol, interval, limit))
     except Exception as e:
-        print(f"Error fetching OHLC: {e}")
+        log_error('klines', e, symbol=symbol, interval=interval)
         return None
 
+# Merges overlapping kline requests, e.g. the 1w chart is the tail of the 1m one
+kline_planner = KlineFetchPlanner()
+
+# Price and 24h change of every listed coin, loaded in one bulk request every few seconds
+ticker_snapshot = TickerSnapshot(
+    binance,
+    coins.symbols(),
+    interval=float(os.environ.get("TICKER_REFRESH_SECONDS", 5))
+)
+
 def get_current_data(symbol):
+    """Current price and 24h change from the shared ticker snapshot"""
+    if not ticker_snapshot.loaded:
+        # Only until the first bulk load succeeds
+        return fetch_current_data(symbol)
+    
+    ticker = ticker_snapshot.get(symbol)
+    if ticker is None:
+        return None
+    return {
+        'last_price': ticker[0],
+        'price_change_percent': ticker[1]
+    }
+
+def fetch_current_data(symbol):
     """Fetch current price and 24h change from Binance"""
-    url = f"https://api.binance.com/api/v3/ticker/24hr?symbol={symbol}"
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = binance.ticker_24hr(symbol)
         return {
             'last_price': float(data['lastPrice']),
             'price_change_percent': float(data['priceChangePercent'])
         }
     except Exception as e:
-        print(f"Error fetching current data: {e}")
+        log_error('ticker', e, symbol=symbol)
         return None
 
-def plot_candlestick(df, coin_name, timeframe, interval):
+# Size and encoding of the chart photos, see charts.OUTPUT_PROFILES
+CHART_PROFILE = get_profile(os.environ.get("CHART_PROFILE", "png"))
+
+# Set by start_process_renderer() when CHART_RENDER_PROCESSES > 0
+process_renderer = None
+
+def start_process_renderer():
+    """Move chart rendering to worker processes if CHART_RENDER_PROCESSES asks for them"""
+    global process_renderer
+    processes = int(os.environ.get("CHART_RENDER_PROCESSES", 0))
+    if processes > 0 and process_renderer is None:
+        process_renderer = ProcessRenderer(processes)
+
+def plot_candlestick(df, coin_name, timeframe, interval, profile=None):
     """Plot candlestick chart with volume and SMA using matplotlib"""
-    
-    # Calculate interval in minutes for width
-    if interval.endswith('m'):
-        min_interval = int(interval[:-1])
-    elif interval.endswith('h'):
-        min_interval = int(interval[:-1]) * 60
-    else:
-        min_interval = 1  # default
-    
-    width = (min_interval / 1440.0) * 0.8  # width in days
-    width2 = width / 10.0  # thin wick
-    
-    up = df[df.close >= df.open]
-    down = df[df.close < df.open]
-    
-    col_up = 'green'
-    col_down = 'red'
-    
-    fig, (ax1, ax2) = plt.subplots(2, 1, gridspec_kw={'height_ratios': [3, 1]}, figsize=(10, 8), sharex=True)
-    
-    # Candlestick bodies
-    ax1.bar(up['open_time'], up['close'] - up['open'], width, bottom=up['open'], color=col_up)
-    ax1.bar(down['open_time'], down['open'] - down['close'], width, bottom=down['close'], color=col_down)
-    
-    # Candlestick wicks
-    ax1.bar(up['open_time'], up['high'] - up['close'], width2, bottom=up['close'], color=col_up)
-    ax1.bar(up['open_time'], up['open'] - up['low'], width2, bottom=up['low'], color=col_up)
-    ax1.bar(down['open_time'], down['high'] - down['open'], width2, bottom=down['open'], color=col_down)
-    ax1.bar(down['open_time'], down['close'] - down['low'], width2, bottom=down['low'], color=col_down)
-    
-    # Simple Moving Average (SMA 20)
-    if len(df) >= 20:
-        sma = df['close'].rolling(window=20).mean()
-        ax1.plot(df['open_time'], sma, color='orange', label='SMA 20')
-        ax1.legend()
-    
-    ax1.set_title(f"{coin_name} Candlestick Chart ({timeframe})")
-    ax1.set_ylabel("Price (USD)")
-    ax1.grid(True)
-    
-    # Volume
-    ax2.bar(df['open_time'], df['volume'], width, color=[col_up if c >= o else col_down for o, c in zip(df['open'], df['close'])])
-    ax2.set_ylabel("Volume")
-    ax2.grid(True)
-    
-    # X-axis formatting
-    ax2.xaxis.set_major_formatter(DateFormatter('%Y-%m-%d %H:%M'))
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    
-    # Save to bytes
-    buf = BytesIO()
-    fig.savefig(buf, format='png', dpi=100)
-    buf.seek(0)
-    plt.close(fig)
-    
-    return buf
+    profile = profile or CHART_PROFILE
+    with STAGE_SECONDS.time(stage='render'):
+        if process_renderer is not None:
+            return process_renderer.render(df, coin_name, timeframe, interval, profile)
+        return render_candlestick(df, coin_name, timeframe, interval, profile)
 
-def get_crypto_chart(coin_full_name, timeframe):
-    """Main function to get chart: fetch data, plot, and return buffer"""
-    symbol = BINANCE_SYMBOLS.get(coin_full_name)
-    if not symbol:
-        return None
+def chart_views(coin_full_name, timeframes):
+    """Map each timeframe of a coin to the (symbol, interval, limit) klines it needs"""
+    symbol = coins.symbol(coin_full_name)
+    views = {}
+    if symbol:
+        for timeframe in timeframes:
+            params = TIMEFRAME_PARAMS.get(timeframe)
+            if params:
+                views[timeframe] = (symbol, params['interval'], params['limit'])
+    return views
+
+def charts_from_frames(timeframes, views, frames):
+    """Pair fetched klines with their chart cache keys, {timeframe: (cache_key, interval, df) or None}"""
+    charts = {}
+    for timeframe in timeframes:
+        view = views.get(timeframe)
+        df = frames.get(view) if view else None
+        if df is None or df.empty:
+            charts[timeframe] = None
+            continue
+        # The same coin, timeframe and last candle always render the same picture
+        cache_key = (view[0], timeframe, df['open_time'].iloc[-1])
+        charts[timeframe] = (cache_key, view[1], df)
+    return charts
+
+def log_stage(stage, metric, what):
+    """Record how long a ParallelStage took under `metric` and log the task it spent that time waiting for"""
+    STAGE_SECONDS.observe(stage.elapsed, stage=metric)
+    name, seconds = stage.critical
+    log_event(
+        'stage',
+        stage=metric,
+        what=what,
+        ms=round(stage.elapsed * 1000),
+        critical_path=name,
+        critical_ms=round(seconds * 1000),
+        missed_deadline=list(stage.late)
+    )
+
+def fetch_request_data(coin_full_name, timeframes):
+    """Fetch the klines behind several charts of one coin, and its ticker, all at once.
+
+    The merged kline calls and the ticker run in parallel under FETCH_DEADLINE.
+    Returns ({timeframe: (cache_key, interval, df) or None}, current data or None).
+    """
+    views = chart_views(coin_full_name, timeframes)
+    unique_views = list(dict.fromkeys(views.values()))
+    plan = kline_planner.plan(unique_views)
     
-    timeframe_params = {
-        '1h': {'interval': '1m', 'limit': 60},
-        '1w': {'interval': '1h', 'limit': 168},
-        '1m': {'interval': '1h', 'limit': 720}
+    tasks = {
+        f"klines {symbol} {interval}": (get_binance_ohlc, symbol, interval, limit)
+        for (symbol, interval), limit in plan.items()
     }
+    tasks['ticker'] = (get_current_data, coins.symbol(coin_full_name))
     
-    params = timeframe_params.get(timeframe)
-    if not params:
-        return None
+    stage = fetch_stage.run(tasks, FETCH_DEADLINE)
+    log_stage(stage, 'fetch', f"{coin_full_name} {'/'.join(timeframes)}")
     
-    df = get_binance_ohlc(symbol, params['interval'], params['limit'])
-    if df is None or df.empty:
-        return None
+    frames = {(symbol, interval): stage.values[f"klines {symbol} {interval}"] for symbol, interval in plan}
+    frames, calls_saved, weight_saved = kline_planner.assemble(unique_views, plan, frames)
+    if calls_saved:
+        log_event('klines_merged', coin=coin_full_name, calls_saved=calls_saved, weight_saved=weight_saved)
     
-    chart_buf = plot_candlestick(df, coin_full_name, timeframe, params['interval'])
-    
-    return chart_buf
+    return charts_from_frames(timeframes, views, frames), stage.values.get('ticker')
+
+def render_chart(chart, coin_full_name, timeframe):
+    """Return the PNG for a chart from fetch_request_data, rendering it only on a cache miss"""
+    cache_key, interval, df = chart
+    png = chart_cache.get_or_render(
+        cache_key,
+        lambda: plot_candlestick(df, coin_full_name, timeframe, interval).getvalue()
+    )
+    return BytesIO(png)
+
+class FrozenMarkup(types.JsonSerializable):
+    """A reply markup serialized once, telebot sends the stored JSON as it is"""
+
+    def __init__(self, markup):
+        # Compact and unescaped, telebot's own to_json spells every non-ASCII character as \uXXXX
+        self.json = json.dumps(markup.to_dict(), ensure_ascii=False, separators=(',', ':'))
+
+    def to_json(self):
+        return self.json
 
+# Coins per page of the coin menu, 0 shows all of them in one keyboard
+COIN_PAGE_SIZE = int(os.environ.get("COIN_PAGE_SIZE", 0))
+
+timeframe_labels = {
+    'en': {'1h': "🕐 1 Hour", '1w': "📅 1 Week", '1m': "🗓️ 1 Month", 'ai': "🤖 AI Analysis"},
+    'fa': {'1h': "🕐 ۱ ساعت", '1w': "📅 ۱ هفته", '1m': "🗓️ ۱ ماه", 'ai': "🤖 تحلیل هوش مصنوعی"},
+    'ar': {'1h': "🕐 ساعة", '1w': "📅 أسبوع", '1m': "🗓️ شهر", 'ai': "🤖 تحليل الذكاء الاصطناعي"},
+}
+
+# The keyboards below never change, each is built and serialized once per arguments
+
+@functools.lru_cache(maxsize=None)
 def create_donation_keyboard():
     """Create inline keyboard with donation options using Telegram Stars"""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -368,8 +543,9 @@ def create_donation_keyboard():
     keyboard.add(button_10, button_25)
     keyboard.add(button_50, button_100)
     
-    return keyboard
+    return FrozenMarkup(keyboard)
 
+@functools.lru_cache(maxsize=None)
 def create_main_menu_keyboard(lang='en'):
     """Create main menu keyboard with donation button"""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -385,61 +561,90 @@ def create_main_menu_keyboard(lang='en'):
     
     keyboard.add(coins_button, donate_button)
     
-    return keyboard
+    return FrozenMarkup(keyboard)
+
+def coin_pages():
+    if not COIN_PAGE_SIZE:
+        return 1
+    return max((len(coins) + COIN_PAGE_SIZE - 1) // COIN_PAGE_SIZE, 1)
 
-def create_crypto_keyboard():
+def create_crypto_keyboard(page=0):
+    """Coin menu, one page of COIN_PAGE_SIZE coins with navigation when paging is on"""
+    return _crypto_keyboard_page(min(max(page, 0), coin_pages() - 1))
+
+@functools.lru_cache(maxsize=None)
+def _crypto_keyboard_page(page):
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     
-    for i in range(0, len(CRYPTO_COINS), 2):
-        row = []
-        for j in range(i, min(i + 2, len(CRYPTO_COINS))):
-            coin = CRYPTO_COINS[j]
-            button = types.InlineKeyboardButton(text=coin, callback_data=f"coin_{j}")
-            row.append(button)
-        keyboard.add(*row)
+    first, last = 0, len(coins)
+    pages = coin_pages()
+    if pages > 1:
+        first = page * COIN_PAGE_SIZE
+        last = min(first + COIN_PAGE_SIZE, len(coins))
     
-    return keyboard
-    keyboard = types.InlineKeyboardMarkup(row_width=2)
-    
-    for i in range(0, len(CRYPTO_COINS), 2):
+    for i in range(first, last, 2):
         row = []
-        for j in range(i, min(i + 2, len(CRYPTO_COINS))):
-            coin = CRYPTO_COINS[j]
-            button = types.InlineKeyboardButton(text=coin, callback_data=f"coin_{j}")
+        for coin in coins.listed[i:min(i + 2, last)]:
+            button = types.InlineKeyboardButton(text=coin.label, callback_data=f"coin_{coin.id}")
             row.append(button)
         keyboard.add(*row)
     
-    return keyboard
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton(text="◀️", callback_data=f"coins_page_{page - 1}"))
+        nav.append(types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"coins_page_{page}"))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton(text="▶️", callback_data=f"coins_page_{page + 1}"))
+        keyboard.row(*nav)
+    
+    return FrozenMarkup(keyboard)
 
-def create_timeframe_keyboard(coin_name):
+@functools.lru_cache(maxsize=None)
+def create_timeframe_keyboard(coin_id, lang='en'):
     keyboard = types.InlineKeyboardMarkup(row_width=2)
+    labels = timeframe_labels[lang]
     
-    button_1h = types.InlineKeyboardButton(text="🕐 1 Hour", callback_data=f"timeframe_{coin_name}_1h")
-    button_1w = types.InlineKeyboardButton(text="📅 1 Week", callback_data=f"timeframe_{coin_name}_1w")
-    button_1m = types.InlineKeyboardButton(text="🗓️ 1 Month", callback_data=f"timeframe_{coin_name}_1m")
-    button_ai = types.InlineKeyboardButton(text="🤖 AI Analysis", callback_data=f"ai_{coin_name}")
+    button_1h = types.InlineKeyboardButton(text=labels['1h'], callback_data=f"tf_{coin_id}_1h")
+    button_1w = types.InlineKeyboardButton(text=labels['1w'], callback_data=f"tf_{coin_id}_1w")
+    button_1m = types.InlineKeyboardButton(text=labels['1m'], callback_data=f"tf_{coin_id}_1m")
+    button_ai = types.InlineKeyboardButton(text=labels['ai'], callback_data=f"ai_{coin_id}")
     
     keyboard.add(button_1h, button_1w)
     keyboard.add(button_1m, button_ai)
-    return keyboard
+    return FrozenMarkup(keyboard)
 
 def send_long_message(chat_id, text, parse_mode=None):
-    """Send long message by splitting into parts"""
+    """Queue a long message in parts, they go out in order"""
     max_length = 4096
     while len(text) > max_length:
         part = text[:max_length]
-        bot.send_message(chat_id, part, parse_mode=parse_mode)
+        outbox.send_message(chat_id, part, parse_mode=parse_mode)
         text = text[max_length:]
     if text:
-        bot.send_message(chat_id, text, parse_mode=parse_mode)
+        outbox.send_message(chat_id, text, parse_mode=parse_mode)
 
+@functools.lru_cache(maxsize=None)
 def create_language_keyboard():
     keyboard = types.InlineKeyboardMarkup(row_width=3)
     button_en = types.InlineKeyboardButton("English", callback_data="lang_en")
     button_fa = types.InlineKeyboardButton("فارسی", callback_data="lang_fa")
     button_ar = types.InlineKeyboardButton("العربية", callback_data="lang_ar")
     keyboard.add(button_en, button_fa, button_ar)
-    return keyboard
+    return FrozenMarkup(keyboard)
+
+def warm_keyboards():
+    """Build every fixed keyboard up front so no handler pays for it"""
+    create_language_keyboard()
+    create_donation_keyboard()
+    for page in range(coin_pages()):
+        create_crypto_keyboard(page)
+    for lang in texts:
+        create_main_menu_keyboard(lang)
+        for coin in coins:
+            create_timeframe_keyboard(coin.id, lang)
+
+warm_keyboards()
 
 def create_google_calendar_link(coin_name, recommendation, price, dt_str, analysis):
     """Create a Google Calendar link"""
@@ -469,33 +674,514 @@ def create_google_calendar_link(coin_name, recommendation, price, dt_str, analys
     
     return calendar_url
 
+def build_ai_prompt(coin_full_name, lang, summary=None, composite=False, current_data=None):
+    """Prompt asking Gemini to analyse the 1h, 1w and 1m charts of a coin.
+
+    With a features.market_summary `summary` the prompt carries the numbers instead of images.
+    """
+    lang_full_name = language_full[lang]
+    
+    if composite:
+        source = f"""Analyze these candlestick charts for {coin_full_name} (with volume and SMA20), stacked in one image:
+    Top chart: 1 hour timeframe
+    Middle chart: 1 week timeframe
+    Bottom chart: 1 month timeframe"""
+    elif summary is None:
+        source = f"""Analyze these candlestick charts for {coin_full_name} (with volume and SMA20):
+    First image: 1 hour timeframe
+    Second image: 1 week timeframe
+    Third image: 1 month timeframe"""
+    else:
+        source = f"""Analyze this market data for {coin_full_name}, summarised from its candlesticks (with volume and SMA20).
+    Keys 1h, 1w and 1m are the 1 hour, 1 week and 1 month timeframes; prices are in USD and
+    recent_candles rows are [open time UTC, open, high, low, close, volume]:
+    {summary}"""
+    
+    if current_data:
+        source += f"""
+    Current price: ${current_data['last_price']} ({current_data['price_change_percent']:+.2f}% in 24h)"""
+    
+    return f"""{source}
+    
+    Provide a very detailed analysis in {lang_full_name} explaining:
+    - Key observations from each timeframe (candlestick patterns, volume trends, SMA20 crossovers, etc.)
+    - The reasoning for your trading recommendation, referencing specific indicators and timeframes used
+    - How the different timeframes influenced your decision
+    
+    Then give a trading recommendation: buy or sell, with a target price, and a suggested datetime in the near future.
+    
+    Output strictly in JSON format: 
+    {{"analysis": "detailed analysis text without markdown bullet points or special formatting",
+    "recommendation": "buy" or "sell", 
+    "price": float, 
+    "datetime": "YYYY-MM-DD HH:MM:SS"}}
+    Do not include any other text or markdown formatting in the analysis field."""
+
+def parse_ai_signal(response_text):
+    """Parse the JSON signal out of a Gemini response, raises if it is malformed"""
+    # Clean up response text
+    response_text = response_text.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text[7:]
+    if response_text.endswith("```"):
+        response_text = response_text[:-3]
+    response_text = response_text.strip()
+    
+    signal = json.loads(response_text)
+    for field in ('analysis', 'recommendation', 'price', 'datetime'):
+        if field not in signal:
+            raise ValueError(f"Missing '{field}' in AI signal")
+    return signal
+
+def format_ai_report(coin_full_name, signal, lang):
+    """Build the analysis message and its keyboard from a parsed AI signal"""
+    analysis = signal['analysis']
+    rec = signal['recommendation'].capitalize()
+    price = signal['price']
+    dt_str = signal['datetime']
+    
+    # Format the beautiful message
+    analysis_text = texts[lang]['ai_header']
+    analysis_text += "─" * 30 + "\n"
+    analysis_text += texts[lang]['analysis_section'].format(analysis)
+    analysis_text += "\n" + "─" * 30
+    analysis_text += texts[lang]['recommendation_section'].format(rec, price, dt_str)
+    analysis_text += "\n" + "─" * 30
+    
+    # Create keyboard with Google Calendar button
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    
+    # Create Google Calendar link
+    calendar_link = create_google_calendar_link(coin_full_name, rec, price, dt_str, analysis)
+    calendar_button = types.InlineKeyboardButton(
+        text="📅 Add to Google Calendar",
+        url=calendar_link
+    )
+    keyboard.add(calendar_button)
+    
+    # Add "Check Another Coin" button
+    another_coin_button = types.InlineKeyboardButton(
+        text="🔍 Check Another Coin",
+        callback_data="show_coins"
+    )
+    keyboard.add(another_coin_button)
+    
+    # Add donation button
+    donate_button = types.InlineKeyboardButton(
+        text="⭐ Support Us" if lang == 'en' else "⭐ حمایت از ما" if lang == 'fa' else "⭐ ادعمنا",
+        callback_data="show_donation"
+    )
+    keyboard.add(donate_button)
+    
+    return analysis_text, keyboard
+
+class EditThrottle:
+    """Decides when a message that is being streamed into is due for another edit"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_edit = 0.0
+        self.last_text = None
+        self.edits = 0
+
+    def ready(self, text):
+        """True if `text` differs from what is shown and enough time has passed"""
+        now = time.monotonic()
+        if text == self.last_text or now < self.next_edit:
+            return False
+        self.last_text = text
+        self.next_edit = now + self.interval
+        self.edits += 1
+        return True
+
+    def backoff(self, seconds):
+        self.next_edit = max(self.next_edit, time.monotonic() + seconds)
+
+_ANALYSIS_START = re.compile(r'"analysis"\s*:\s*"')
+
+def partial_analysis(response_text):
+    """Decode the "analysis" string of a JSON signal that is still being streamed"""
+    match = _ANALYSIS_START.search(response_text)
+    if not match:
+        return ''
+
+    raw = response_text[match.end():]
+    # Stop at the closing quote, or before an escape sequence that has not fully arrived
+    i = 0
+    while i < len(raw) and raw[i] != '"':
+        if raw[i] == '\\':
+            step = 6 if raw[i + 1:i + 2] == 'u' else 2
+            if i + step > len(raw):
+                break
+            i += step
+        else:
+            i += 1
+
+    try:
+        return json.loads(f'"{raw[:i]}"', strict=False)
+    except ValueError:
+        return raw[:i]
+
+def stream_preview(response_text, lang, limit=3500):
+    """HTML for the processing message while the analysis streams in, None before it starts"""
+    analysis = partial_analysis(response_text).strip()
+    if not analysis:
+        return None
+    if len(analysis) > limit:
+        # Keep the newest text on screen, a message can't grow past 4096 characters
+        analysis = "…" + analysis[-limit:]
+    return texts[lang]['ai_header'] + texts[lang]['analysis_section'].format(html.escape(analysis) + " ▌")
+
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     chat_id = message.chat.id
-    lang = user_languages.get(chat_id, 'en')
-    bot.reply_to(message, texts[lang]['select_language'], reply_markup=create_language_keyboard())
+    lang = preferences.language(chat_id)
+    outbox.reply_to(message, texts[lang]['select_language'], reply_markup=create_language_keyboard())
 
 @bot.message_handler(commands=['donate'])
 def send_donation(message):
     chat_id = message.chat.id
-    lang = user_languages.get(chat_id, 'en')
-    bot.reply_to(
+    lang = preferences.language(chat_id)
+    outbox.reply_to(
         message,
         texts[lang]['donation_thanks'],
         reply_markup=create_donation_keyboard(),
         parse_mode='HTML'
     )
 
+def handle_timeframe(call, lang):
+    """Fetch, render and send a chart, runs on the chart worker pool"""
+    parts = call.data.split("_", 2)
+    coin = coin_from_callback(parts[1])
+    timeframe = parts[2]
+    
+    if coin is None:
+        log_event('coin_not_found', value=parts[1])
+        outbox.answer_callback_query(
+            call.id,
+            "❌ Sorry, this coin is not available",
+            show_alert=True
+        )
+        return
+    
+    coin_full_name = coin.name
+    readable_timeframe = timeframe_labels[lang].get(timeframe, timeframe)
+    
+    processing_msg = outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=texts[lang]['loading_chart'].format(coin_full_name, readable_timeframe),
+        parse_mode='HTML'
+    ).result()
+    
+    try:
+        charts, current_data = fetch_request_data(coin_full_name, [timeframe])
+        chart = charts[timeframe]
+        
+        if chart and current_data:
+            cache_key, interval, _ = chart
+            caption = texts[lang]['chart_caption'].format(coin_full_name, readable_timeframe, current_data['last_price'], current_data['price_change_percent'])
+            
+            # Resend a chart Telegram already has instead of uploading the PNG again
+            sent = False
+            file_id = chart_file_ids.get(cache_key)
+            if file_id:
+                try:
+                    outbox.send_photo(
+                        call.message.chat.id,
+                        file_id,
+                        caption=caption,
+                        parse_mode='HTML'
+                    ).result()
+                    sent = True
+                except apihelper.ApiTelegramException as e:
+                    log_event('file_id_rejected', error=str(e))
+                    chart_file_ids.pop(cache_key)
+            
+            if not sent:
+                photo_msg = outbox.send_photo(
+                    call.message.chat.id,
+                    render_chart(chart, coin_full_name, timeframe),
+                    caption=caption,
+                    parse_mode='HTML'
+                ).result()
+                chart_file_ids.set(cache_key, photo_msg.photo[-1].file_id, next_candle_close(interval))
+            
+            outbox.delete_message(call.message.chat.id, processing_msg.message_id)
+            outbox.send_message(
+                call.message.chat.id,
+                texts[lang]['another_coin'],
+                reply_markup=create_crypto_keyboard()
+            )
+            
+        else:
+            outbox.edit_message_text(
+                chat_id=call.message.chat.id,
+                message_id=processing_msg.message_id,
+                text=texts[lang]['error_chart'].format(coin_full_name, readable_timeframe),
+                parse_mode='HTML'
+            )
+            
+    except Exception as e:
+        log_error('timeframe', e, coin=coin_full_name, timeframe=timeframe)
+        outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=processing_msg.message_id,
+            text=texts[lang]['error_general'],
+            parse_mode='HTML'
+        )
+
+class AIResponseError(Exception):
+    """Gemini answered, but not with the signal JSON we asked for"""
+
+    def __init__(self, message, text):
+        super().__init__(message)
+        self.text = text
+
+def ai_cache_key(coin_full_name, lang):
+    """Analyses are shared per coin and language until the current hourly candle closes"""
+    return f"{coin_full_name}|{lang}|{int(next_candle_close('1h'))}"
+
+def chart_image(chart, coin_full_name, timeframe):
+    """One chart as a PIL image for Gemini"""
+    if AI_RASTER:
+        _, interval, df = chart
+        return plot_candlestick(df, coin_full_name, timeframe, interval, get_profile('ai'))
+    # Decode the PNG the timeframe view may already have cached
+    return Image.open(render_chart(chart, coin_full_name, timeframe))
+
+def image_contents(coin_full_name, lang, images, current_data=None):
+    """Gemini input for the image mode: the prompt and the 1h, 1w and 1m chart images"""
+    if AI_COMPOSITE:
+        return [build_ai_prompt(coin_full_name, lang, composite=True, current_data=current_data), composite_image(images)]
+    return [build_ai_prompt(coin_full_name, lang, current_data=current_data), *images]
+
+def chart_image_contents(coin_full_name, lang, charts, current_data=None):
+    """Render the three charts in parallel and build the image mode input from them"""
+    stage = render_stage.run({
+        timeframe: (chart_image, charts[timeframe], coin_full_name, timeframe)
+        for timeframe in ('1h', '1w', '1m')
+    })
+    log_stage(stage, 'ai_render', f"{coin_full_name} AI charts")
+    
+    images = [stage.values[timeframe] for timeframe in ('1h', '1w', '1m')]
+    if not all(images):
+        raise Exception("Failed to render one or more charts")
+    return image_contents(coin_full_name, lang, images, current_data)
+
+def feature_contents(coin_full_name, lang, charts, current_data=None):
+    """Gemini input for the features mode: one text prompt, nothing is rendered"""
+    frames = {timeframe: (interval, df) for timeframe, (_, interval, df) in charts.items()}
+    return [build_ai_prompt(coin_full_name, lang, market_summary(frames), current_data=current_data)]
+
+def run_ai_analysis(coin_full_name, lang, on_progress=None):
+    """Ask Gemini about the 1h, 1w and 1m klines of a coin and return the parsed signal.
+
+    With `on_progress` the answer is streamed and the callback gets the text received so far.
+    """
+    started = time.perf_counter()
+    
+    # Fetch all timeframes and the ticker at once, 1w is sliced from the 1m klines
+    charts, current_data = fetch_request_data(coin_full_name, ['1h', '1w', '1m'])
+    
+    if not all(charts.values()):
+        raise Exception("Failed to generate one or more charts")
+    
+    if AI_INPUT == 'features':
+        contents = feature_contents(coin_full_name, lang, charts, current_data)
+    else:
+        contents = chart_image_contents(coin_full_name, lang, charts, current_data)
+    
+    seconds = time.perf_counter() - started
+    STAGE_SECONDS.observe(seconds, stage='ai_input')
+    log_event('ai_input_ready', coin=coin_full_name, mode=AI_INPUT, ms=round(seconds * 1000))
+    
+    model = genai.GenerativeModel('gemini-2.5-flash')
+    
+    with STAGE_SECONDS.time(stage='gemini'):
+        if on_progress is None:
+            response_text = model.generate_content(contents).text
+        else:
+            response_text = ''
+            for chunk in model.generate_content(contents, stream=True):
+                response_text += chunk.text
+                on_progress(response_text)
+    
+    try:
+        return parse_ai_signal(response_text)
+    except Exception as e:
+        raise AIResponseError(str(e), response_text)
+
+def handle_ai(call, lang):
+    """Run the Gemini analysis for a coin, runs on the AI worker pool"""
+    coin = coin_from_callback(call.data.split("_", 1)[1])
+    
+    if coin is None:
+        log_event('coin_not_found', value=call.data)
+        outbox.answer_callback_query(
+            call.id,
+            "❌ Sorry, this coin is not available",
+            show_alert=True
+        )
+        return
+    
+    coin_full_name = coin.name
+    
+    processing_msg = outbox.edit_message_text(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=texts[lang]['loading_ai'].format(coin_full_name),
+        parse_mode='HTML'
+    ).result()
+    
+    throttle = EditThrottle(AI_STREAM_EDIT_INTERVAL)
+    
+    def show_progress(response_text):
+        preview = stream_preview(response_text, lang)
+        if preview is None or not throttle.ready(preview):
+            return
+        # Queued behind the earlier previews, a 429 holds the chat's queue instead of dropping edits
+        outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=processing_msg.message_id,
+            text=preview,
+            parse_mode='HTML'
+        )
+    
+    try:
+        try:
+            signal = ai_cache.get_or_compute(
+                ai_cache_key(coin_full_name, lang),
+                lambda: run_ai_analysis(coin_full_name, lang, show_progress if AI_STREAM else None)
+            )
+            analysis_text, keyboard = format_ai_report(coin_full_name, signal, lang)
+        except AIResponseError as parse_e:
+            log_error('ai_parse', parse_e, coin=coin_full_name)
+            analysis_text = f"<b>AI Analysis:</b>\n\n{parse_e.text}"
+            keyboard = create_crypto_keyboard()
+        
+        # The processing message already shows the streamed analysis, finish it in place
+        finished_in_place = False
+        if throttle.edits and len(analysis_text) <= 4096:
+            try:
+                outbox.edit_message_text(
+                    chat_id=call.message.chat.id,
+                    message_id=processing_msg.message_id,
+                    text=analysis_text,
+                    parse_mode='HTML'
+                ).result()
+                finished_in_place = True
+            except apihelper.ApiTelegramException as e:
+                log_error('ai_stream', e, coin=coin_full_name)
+        
+        # Send analysis
+        if not finished_in_place:
+            send_long_message(call.message.chat.id, analysis_text, parse_mode='HTML')
+        
+        # Send keyboard
+        outbox.send_message(
+            call.message.chat.id,
+            texts[lang]['another_coin'],
+            reply_markup=keyboard
+        )
+        
+        if not finished_in_place:
+            outbox.delete_message(call.message.chat.id, processing_msg.message_id)
+        
+    except Exception as e:
+        log_error('ai', e, coin=coin_full_name)
+        outbox.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=processing_msg.message_id,
+            text=texts[lang]['error_ai'],
+            parse_mode='HTML'
+        )
+
+def traced_job(handler, action, call, lang):
+    """Run a slow callback, timing it and counting how it ended"""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        handler(call, lang)
+        outcome = 'ok'
+    finally:
+        seconds = time.perf_counter() - started
+        CALLBACK_SECONDS.observe(seconds, action=action)
+        CALLBACKS.inc(action=action, outcome=outcome)
+        log_event('callback_done', action=action, outcome=outcome, ms=round(seconds * 1000))
+
+def submit_slow_job(call, pool, handler, lang):
+    """Queue a slow callback for its chat, or tell the user why it was not queued"""
+    # The job runs on a pool thread, carry the request ID over to it
+    context = contextvars.copy_context()
+    status = slow_jobs.submit(call.message.chat.id, pool, call.data, context.run, traced_job, handler, pool, call, lang)
+    if status == JOB_BUSY:
+        CALLBACKS.inc(action=pool, outcome='busy')
+        outbox.answer_callback_query(call.id, texts[lang]['busy'], show_alert=True)
+    elif status == JOB_DUPLICATE:
+        CALLBACKS.inc(action=pool, outcome='duplicate')
+        outbox.answer_callback_query(call.id, texts[lang]['in_progress'])
+
+def register_gauges():
+    """Cache hit counts, queue depths and the Binance weight budget, read at every scrape"""
+    caches = {'klines': kline_cache, 'charts': chart_cache, 'file_ids': chart_file_ids, 'ai': ai_cache}
+    REGISTRY.gauge(
+        'botrader_cache_hits_total', 'Cache hits by cache',
+        lambda: {name: cache.hits for name, cache in caches.items()}, labels=('cache',), kind='counter'
+    )
+    REGISTRY.gauge(
+        'botrader_cache_misses_total', 'Cache misses by cache',
+        lambda: {name: cache.misses for name, cache in caches.items()}, labels=('cache',), kind='counter'
+    )
+    REGISTRY.gauge(
+        'botrader_cache_hit_ratio', 'Share of lookups answered from the cache since start',
+        lambda: {
+            name: cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else None
+            for name, cache in caches.items()
+        },
+        labels=('cache',)
+    )
+    REGISTRY.gauge(
+        'botrader_queue_depth', 'Queued and running work by queue',
+        lambda: {
+            'chart_jobs': slow_jobs.depth('chart'),
+            'ai_jobs': slow_jobs.depth('ai'),
+            'telegram_sends': send_queue.pending,
+            'binance_weight_waiters': binance_limiter.waiting,
+        },
+        labels=('queue',)
+    )
+    REGISTRY.gauge(
+        'botrader_binance_weight', 'Binance request weight: our available budget and the used weight Binance last reported',
+        lambda: {
+            key: value for key, value in binance_limiter.budget().items()
+            if key in ('available', 'used_weight')
+        },
+        labels=('kind',)
+    )
+    REGISTRY.gauge(
+        'botrader_binance_shed_total', 'Binance calls shed by the weight limiter, by priority',
+        lambda: {
+            priority: binance_limiter.budget()[f'shed_{priority}']
+            for priority in ('interactive', 'background')
+        },
+        labels=('priority',), kind='counter'
+    )
+
+register_gauges()
+
 @bot.callback_query_handler(func=lambda call: True)
 def callback_query(call):
     chat_id = call.message.chat.id
-    lang = user_languages.get(chat_id, 'en')
+    lang = preferences.language(chat_id)
+    new_request_id()
+    log_event('callback', data=call.data, chat_id=chat_id)
     
     if call.data.startswith("lang_"):
         new_lang = call.data.split("_")[1]
-        user_languages[chat_id] = new_lang
-        bot.answer_callback_query(call.id, texts[new_lang]['language_set'].format(language_full[new_lang]))
-        bot.edit_message_text(
+        preferences.set_language(chat_id, new_lang)
+        outbox.answer_callback_query(call.id, texts[new_lang]['language_set'].format(language_full[new_lang]))
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text=texts[new_lang]['welcome'],
@@ -503,21 +1189,23 @@ def callback_query(call):
         )
         return
     
-    lang = user_languages.get(chat_id, 'en')
+    lang = preferences.language(chat_id)
     
     if call.data.startswith("coin_"):
-        coin_index = int(call.data.split("_")[1])
-        selected_coin = CRYPTO_COINS[coin_index]
-        clean_coin_name = selected_coin.split(' ', 1)[1]
+        coin = coin_from_callback(call.data.split("_")[1])
+        if coin is None:
+            outbox.answer_callback_query(call.id, "❌ Sorry, this coin is not available", show_alert=True)
+            return
+        clean_coin_name = coin.name
         
-        bot.answer_callback_query(
+        outbox.answer_callback_query(
             call.id, 
             f"🎯 Selected: {clean_coin_name}",
             show_alert=False
         )
         
-        timeframe_keyboard = create_timeframe_keyboard(clean_coin_name)
-        bot.edit_message_text(
+        timeframe_keyboard = create_timeframe_keyboard(coin.id, lang)
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text=texts[lang]['selected'].format(clean_coin_name),
@@ -525,222 +1213,23 @@ def callback_query(call):
             parse_mode='HTML'
         )
     
-    elif call.data.startswith("timeframe_"):
-        parts = call.data.split("_", 2)
-        coin_full_name = parts[1]
-        timeframe = parts[2]
-        
-        symbol = BINANCE_SYMBOLS.get(coin_full_name)
-        
-        if not symbol:
-            print(f"Coin not found in mapping: {coin_full_name}")
-            bot.answer_callback_query(
-                call.id,
-                "❌ Sorry, this coin is not available",
-                show_alert=True
-            )
-            return
-        
-        timeframe_map = {
-            '1h': '🕐 1 Hour',
-            '1w': '📅 1 Week', 
-            '1m': '🗓️ 1 Month'
-        }
-        
-        readable_timeframe = timeframe_map.get(timeframe, timeframe)
-        
-        processing_msg = bot.edit_message_text(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=texts[lang]['loading_chart'].format(coin_full_name, readable_timeframe),
-            parse_mode='HTML'
-        )
-        
-        try:
-            chart_buf = get_crypto_chart(coin_full_name, timeframe)
-            
-            current_data = get_current_data(symbol)
-            
-            if chart_buf:
-                caption = texts[lang]['chart_caption'].format(coin_full_name, readable_timeframe, current_data['last_price'], current_data['price_change_percent'])
-                
-                bot.send_photo(
-                    call.message.chat.id,
-                    chart_buf,
-                    caption=caption,
-                    parse_mode='HTML'
-                )
-                
-                try:
-                    bot.delete_message(call.message.chat.id, processing_msg.message_id)
-                except:
-                    pass
-                
-                bot.send_message(
-                    call.message.chat.id,
-                    texts[lang]['another_coin'],
-                    reply_markup=create_crypto_keyboard()
-                )
-                
-            else:
-                bot.edit_message_text(
-                    chat_id=call.message.chat.id,
-                    message_id=processing_msg.message_id,
-                    text=texts[lang]['error_chart'].format(coin_full_name, readable_timeframe),
-                    parse_mode='HTML'
-                )
-                
-        except Exception as e:
-            print(f"Error in timeframe handler: {e}")
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=processing_msg.message_id,
-                text=texts[lang]['error_general'],
-                parse_mode='HTML'
-            )
+    elif call.data.startswith(("tf_", "timeframe_")):
+        submit_slow_job(call, 'chart', handle_timeframe, lang)
     
     elif call.data.startswith("ai_"):
-        coin_full_name = call.data.split("_", 1)[1]
-        
-        symbol = BINANCE_SYMBOLS.get(coin_full_name)
-        
-        if not symbol:
-            print(f"Coin not found in mapping: {coin_full_name}")
-            bot.answer_callback_query(
-                call.id,
-                "❌ Sorry, this coin is not available",
-                show_alert=True
-            )
-            return
-        
-        processing_msg = bot.edit_message_text(
+        submit_slow_job(call, 'ai', handle_ai, lang)
+    
+    elif call.data.startswith("coins_page_"):
+        outbox.answer_callback_query(call.id)
+        # Tapping the current page number leaves the markup unchanged, which the queue ignores
+        outbox.edit_message_reply_markup(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            text=texts[lang]['loading_ai'].format(coin_full_name),
-            parse_mode='HTML'
+            reply_markup=create_crypto_keyboard(int(call.data.rsplit("_", 1)[1]))
         )
-        
-        try:
-            # Generate charts for all timeframes
-            chart_1h = get_crypto_chart(coin_full_name, '1h')
-            chart_1w = get_crypto_chart(coin_full_name, '1w')
-            chart_1m = get_crypto_chart(coin_full_name, '1m')
-            
-            if not all([chart_1h, chart_1w, chart_1m]):
-                raise Exception("Failed to generate one or more charts")
-            
-            # Prepare Gemini parts - convert images to PIL Image objects
-            from PIL import Image as PILImage
-            
-            img_1h = PILImage.open(chart_1h)
-            img_1w = PILImage.open(chart_1w)
-            img_1m = PILImage.open(chart_1m)
-            
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            lang_full_name = language_full[lang]
-            
-            prompt = f"""Analyze these candlestick charts for {coin_full_name} (with volume and SMA20):
-            First image: 1 hour timeframe
-            Second image: 1 week timeframe
-            Third image: 1 month timeframe
-            
-            Provide a very detailed analysis in {lang_full_name} explaining:
-            - Key observations from each timeframe (candlestick patterns, volume trends, SMA20 crossovers, etc.)
-            - The reasoning for your trading recommendation, referencing specific indicators and timeframes used
-            - How the different timeframes influenced your decision
-            
-            Then give a trading recommendation: buy or sell, with a target price, and a suggested datetime in the near future.
-            
-            Output strictly in JSON format: 
-            {{"analysis": "detailed analysis text without markdown bullet points or special formatting",
-            "recommendation": "buy" or "sell", 
-            "price": float, 
-            "datetime": "YYYY-MM-DD HH:MM:SS"}}
-            Do not include any other text or markdown formatting in the analysis field."""
-            
-            response = model.generate_content([prompt, img_1h, img_1w, img_1m])
-            
-            # Parse JSON
-            try:
-                # Clean up response text
-                response_text = response.text.strip()
-                if response_text.startswith("```json"):
-                    response_text = response_text[7:]
-                if response_text.endswith("```"):
-                    response_text = response_text[:-3]
-                response_text = response_text.strip()
-                
-                signal = json.loads(response_text)
-                analysis = signal['analysis']
-                rec = signal['recommendation'].capitalize()
-                price = signal['price']
-                dt_str = signal['datetime']
-                
-                # Format the beautiful message
-                analysis_text = texts[lang]['ai_header']
-                analysis_text += "─" * 30 + "\n"
-                analysis_text += texts[lang]['analysis_section'].format(analysis)
-                analysis_text += "\n" + "─" * 30
-                analysis_text += texts[lang]['recommendation_section'].format(rec, price, dt_str)
-                analysis_text += "\n" + "─" * 30
-                
-                # Create keyboard with Google Calendar button
-                keyboard = types.InlineKeyboardMarkup(row_width=1)
-                
-                # Create Google Calendar link
-                calendar_link = create_google_calendar_link(coin_full_name, rec, price, dt_str, analysis)
-                calendar_button = types.InlineKeyboardButton(
-                    text="📅 Add to Google Calendar",
-                    url=calendar_link
-                )
-                keyboard.add(calendar_button)
-                
-                # Add "Check Another Coin" button
-                another_coin_button = types.InlineKeyboardButton(
-                    text="🔍 Check Another Coin",
-                    callback_data="show_coins"
-                )
-                keyboard.add(another_coin_button)
-                
-                # Add donation button
-                donate_button = types.InlineKeyboardButton(
-                    text="⭐ Support Us" if lang == 'en' else "⭐ حمایت از ما" if lang == 'fa' else "⭐ ادعمنا",
-                    callback_data="show_donation"
-                )
-                keyboard.add(donate_button)
-                
-            except Exception as parse_e:
-                print(f"JSON parse error: {parse_e}")
-                analysis_text = f"<b>AI Analysis:</b>\n\n{response.text}"
-                keyboard = create_crypto_keyboard()
-            
-            # Send analysis
-            send_long_message(call.message.chat.id, analysis_text, parse_mode='HTML')
-            
-            # Send keyboard
-            bot.send_message(
-                call.message.chat.id,
-                texts[lang]['another_coin'],
-                reply_markup=keyboard
-            )
-            
-            try:
-                bot.delete_message(call.message.chat.id, processing_msg.message_id)
-            except:
-                pass
-            
-        except Exception as e:
-            print(f"Error in AI handler: {e}")
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=processing_msg.message_id,
-                text=texts[lang]['error_ai'],
-                parse_mode='HTML'
-            )
     
     elif call.data == "show_coins":
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text=texts[lang]['available_coins'],
@@ -748,7 +1237,7 @@ def callback_query(call):
         )
     
     elif call.data == "show_donation":
-        bot.edit_message_text(
+        outbox.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text=texts[lang]['donation_thanks'],
@@ -760,40 +1249,41 @@ def callback_query(call):
         # Extract star amount
         star_amount = int(call.data.split("_")[1])
         
-        try:
-            # Create invoice for Telegram Stars
-            prices = [types.LabeledPrice(label=f"{star_amount} Telegram Stars", amount=star_amount)]
-            
-            bot.send_invoice(
-                chat_id=call.message.chat.id,
-                title=f"Support Crypto Tracker Bot",
-                description=f"Thank you for supporting our bot with {star_amount} Telegram Stars! Your contribution helps us maintain and improve the service.",
-                invoice_payload=f"donate_{star_amount}_stars",
-                provider_token="",  # Empty for Telegram Stars
-                currency="XTR",  # Telegram Stars currency code
-                prices=prices,
-                start_parameter="donate"
-            )
-            
-            bot.answer_callback_query(
-                call.id,
-                f"⭐ Payment request sent for {star_amount} stars!",
-                show_alert=False
-            )
-            
-        except Exception as e:
-            print(f"Error creating invoice: {e}")
-            bot.answer_callback_query(
-                call.id,
-                "❌ Sorry, there was an error processing your donation request.",
-                show_alert=True
-            )
+        def answer(invoice):
+            # Answer the button once the queued invoice has gone out, or failed to
+            if invoice.exception() is None:
+                outbox.answer_callback_query(
+                    call.id,
+                    f"⭐ Payment request sent for {star_amount} stars!",
+                    show_alert=False
+                )
+            else:
+                log_error('invoice', invoice.exception(), stars=star_amount)
+                outbox.answer_callback_query(
+                    call.id,
+                    "❌ Sorry, there was an error processing your donation request.",
+                    show_alert=True
+                )
+        
+        # Create invoice for Telegram Stars
+        prices = [types.LabeledPrice(label=f"{star_amount} Telegram Stars", amount=star_amount)]
+        
+        outbox.send_invoice(
+            chat_id=call.message.chat.id,
+            title=f"Support Crypto Tracker Bot",
+            description=f"Thank you for supporting our bot with {star_amount} Telegram Stars! Your contribution helps us maintain and improve the service.",
+            invoice_payload=f"donate_{star_amount}_stars",
+            provider_token="",  # Empty for Telegram Stars
+            currency="XTR",  # Telegram Stars currency code
+            prices=prices,
+            start_parameter="donate"
+        ).add_done_callback(answer)
 
 @bot.message_handler(commands=['coins'])
 def show_coins(message):
     chat_id = message.chat.id
-    lang = user_languages.get(chat_id, 'en')
-    bot.reply_to(
+    lang = preferences.language(chat_id)
+    outbox.reply_to(
         message, 
         texts[lang]['available_coins'],
         reply_markup=create_crypto_keyboard()
@@ -802,7 +1292,7 @@ def show_coins(message):
 # Handle successful payment
 @bot.pre_checkout_query_handler(func=lambda query: True)
 def checkout(pre_checkout_query):
-    bot.answer_pre_checkout_query(
+    outbox.answer_pre_checkout_query(
         pre_checkout_query.id,
         ok=True,
         error_message="Something went wrong. Please try again later."
@@ -811,12 +1301,12 @@ def checkout(pre_checkout_query):
 @bot.message_handler(content_types=['successful_payment'])
 def got_payment(message):
     chat_id = message.chat.id
-    lang = user_languages.get(chat_id, 'en')
+    lang = preferences.language(chat_id)
     
     # Extract star amount from invoice payload
     payload = message.successful_payment.invoice_payload
     
-    bot.send_message(
+    outbox.send_message(
         chat_id,
         texts[lang]['donation_success'],
         reply_markup=create_main_menu_keyboard(lang),
@@ -826,11 +1316,18 @@ def got_payment(message):
 @bot.message_handler(func=lambda message: True)
 def handle_text(message):
     chat_id = message.chat.id
-    lang = user_languages.get(chat_id, 'en')
-    bot.reply_to(
+    lang = preferences.language(chat_id)
+    outbox.reply_to(
         message,
         texts[lang]['handle_text'],
         reply_markup=create_crypto_keyboard()
     )
 
-bot.infinity_polling()
\ No newline at end of file
+if __name__ == '__main__':
+    start_process_renderer()
+    ticker_snapshot.start()
+    start_exchange_info_refresh()
+    start_metrics_server()
+    # getUpdates is refused while a webhook from webhook.py is still registered
+    bot.remove_webhook()
+    bot.infinity_polling()
\ No newline at end of file
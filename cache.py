@@ -0,0 +1,450 @@
+"""In-process caches shared by the bot's request handlers"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from metrics import log_error
+
+# Length of each Binance kline interval in seconds ('1M' is handled separately)
+INTERVAL_SECONDS = {
+    '1s': 1,
+    '1m': 60,
+    '3m': 180,
+    '5m': 300,
+    '15m': 900,
+    '30m': 1800,
+    '1h': 3600,
+    '2h': 7200,
+    '4h': 14400,
+    '6h': 21600,
+    '8h': 28800,
+    '12h': 43200,
+    '1d': 86400,
+    '3d': 259200,
+    '1w': 604800,
+}
+
+# Binance weekly candles open on Monday 00:00 UTC, the Unix epoch was a Thursday
+WEEK_OFFSET = 4 * 86400
+
+
+def next_candle_close(interval, now=None):
+    """Return the Unix time at which the candle open at `now` closes"""
+    if now is None:
+        now = time.time()
+
+    if interval == '1M':
+        dt = datetime.fromtimestamp(now, tz=timezone.utc)
+        year, month = (dt.year + 1, 1) if dt.month == 12 else (dt.year, dt.month + 1)
+        return datetime(year, month, 1, tzinfo=timezone.utc).timestamp()
+
+    seconds = INTERVAL_SECONDS[interval]
+    offset = WEEK_OFFSET if interval == '1w' else 0
+    return ((now - offset) // seconds + 1) * seconds + offset
+
+
+class _Flight:
+    """A call in progress that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into a single execution"""
+
+    def __init__(self):
+        self._flights = {}  # key -> _Flight
+        self._lock = threading.Lock()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def do(self, key, fn):
+        """Run `fn()` unless a call for `key` is running already, then share its result"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fn()
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class AsyncSingleFlight:
+    """Asyncio counterpart of SingleFlight, concurrent awaits share one coroutine run"""
+
+    def __init__(self):
+        self._flights = {}  # key -> asyncio.Future
+
+    async def do(self, key, fn):
+        """Await `fn()` unless a call for `key` is running already, then share its result"""
+        future = self._flights.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may be waiting, don't let asyncio log the exception as never retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            del self._flights[key]
+
+
+class KlineCache:
+    """Bounded LRU cache of kline frames that expire when their candle closes.
+
+    Callers that find no entry wait for the fetch already running for that key,
+    and while an expired entry is being refreshed the other callers keep getting
+    the stale frame, so a burst of identical requests costs one upstream call.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_fetch(self, key, interval, fetch):
+        """Return the cached value for `key`, calling `fetch()` at most once per candle"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry[1] > time.time():
+                    self.hits += 1
+                    return entry[0]
+                if self._flights.in_flight(key):
+                    # Someone is already refreshing, serve the previous candle meanwhile
+                    self.stale_hits += 1
+                    return entry[0]
+
+        return self._flights.do(key, lambda: self._refresh(key, interval, fetch, entry))
+
+    def peek(self, key):
+        """Return the value for `key` if it is cached and its candle is still open"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def store(self, key, value, expires_at):
+        """Cache a value fetched outside get_or_fetch, e.g. by the asyncio engine"""
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, key, interval, fetch, entry):
+        with self._lock:
+            # A flight that finished just before this one started may have stored it already
+            current = self._entries.get(key)
+            if current is not None and current[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return current[0]
+            self.misses += 1
+        # Expire at the close of the candle the fetch started in, not the one it ended in
+        expires_at = next_candle_close(interval)
+
+        value = fetch()
+
+        with self._lock:
+            if value is not None:
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            elif entry is not None:
+                # Refresh failed, keep answering with the stale frame
+                value = entry[0]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ChartCache:
+    """LRU cache of rendered chart images bounded by their total size in bytes.
+
+    Renders for the same key are single-flight: concurrent callers wait for the
+    render that is already running instead of starting their own.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> bytes
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_render(self, key, render):
+        """Return the image bytes for `key`, calling `render()` only on a miss"""
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+        return self._flights.do(key, lambda: self._render(key, render))
+
+    def _render(self, key, render):
+        # A render for this key may have finished while we were acquiring the flight
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            self.misses += 1
+        value = render()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class FileIdCache:
+    """Bounded LRU mapping whose entries each carry their own expiry time"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry is not None else None
+
+
+def write_atomic(path, write):
+    """Replace `path` in one step with what `write(f)` writes to a text file.
+
+    Each call writes its own temp file next to `path`, so concurrent writers
+    (threads or processes) never clobber each other's half-written data.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory,
+                                     prefix=f".{os.path.basename(path)}.", suffix='.tmp', delete=False) as f:
+        tmp_path = f.name
+        try:
+            write(f)
+        except BaseException:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+    try:
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class PersistentTTLCache:
+    """Bounded LRU of JSON-serializable values with a fixed TTL, mirrored to a file.
+
+    The file is rewritten atomically after every store and loaded again on
+    startup, so entries survive restarts. Computations for the same key are
+    single-flight: concurrent callers wait for the one that is running.
+    """
+
+    def __init__(self, path=None, ttl=3600, max_entries=512):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self.save()
+
+    def lookup(self, key):
+        """get() that counts a hit when the value is there"""
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+        return value
+
+    def miss(self):
+        """Count a lookup that had to compute its value"""
+        with self._lock:
+            self.misses += 1
+
+    def get_or_compute(self, key, compute):
+        """Return the value for `key`, calling `compute()` only on a miss.
+
+        Nothing is cached when `compute()` raises or returns None.
+        """
+        value = self.lookup(key)
+        if value is not None:
+            return value
+        return self._flights.do(key, lambda: self._compute(key, compute))
+
+    def _compute(self, key, compute):
+        # The previous flight for this key may have stored it while we waited for the lock
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        self.miss()
+        value = compute()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def load(self):
+        """Read the entries saved by a previous run, dropping the expired ones"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            log_error('cache_load', e, path=self.path)
+            return
+
+        now = time.time()
+        with self._lock:
+            for key, value, expires_at in saved:
+                if expires_at > now:
+                    self._entries[key] = (value, expires_at)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """Write the live entries to disk, replacing the old file in one step"""
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            entries = [[key, value, expires_at] for key, (value, expires_at) in self._entries.items() if expires_at > now]
+
+        with self._save_lock:
+            try:
+                write_atomic(self.path, lambda f: json.dump(entries, f, ensure_ascii=False))
+            except (OSError, TypeError, ValueError) as e:
+                log_error('cache_save', e, path=self.path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.save()
@@ -0,0 +1,393 @@
+"""Candlestick chart rendering.
+
+Candles are drawn as a handful of collections built straight from NumPy
+arrays, on a standalone `Figure` with its own Agg canvas, so no global pyplot
+state is touched and renders can run in parallel threads.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+from io import BytesIO
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.colors import to_rgba
+from matplotlib.dates import DateFormatter, date2num
+from matplotlib.figure import Figure
+from PIL import Image
+
+from metrics import REGISTRY, STAGE_SECONDS
+
+COL_UP = to_rgba('green')
+COL_DOWN = to_rgba('red')
+COL_SMA = 'orange'
+
+SMA_WINDOW = 20
+
+# Pixel size comes from figsize (inches) * dpi. format is 'png', 'png8'
+# (palette-quantized PNG), 'webp', 'jpeg' or 'raster' (an unencoded PIL image);
+# quality applies to the lossy formats and colors to png8.
+OutputProfile = namedtuple('OutputProfile', 'name figsize dpi format quality colors')
+
+OUTPUT_PROFILES = {
+    # 1000x800 RGBA PNG, what the bot always sent
+    'png': OutputProfile('png', (10, 8), 100, 'png', None, None),
+    # Same picture, the two-color chart fits a small palette
+    'png8': OutputProfile('png8', (10, 8), 100, 'png8', None, 64),
+    'webp': OutputProfile('webp', (10, 8), 100, 'webp', 80, None),
+    'jpeg': OutputProfile('jpeg', (10, 8), 100, 'jpeg', 85, None),
+    # 800x640 for phones on slow networks
+    'mobile': OutputProfile('mobile', (10, 8), 80, 'png8', None, 32),
+    'mobile-webp': OutputProfile('mobile-webp', (10, 8), 80, 'webp', 70, None),
+    # 640x512 RGB image for Gemini, fits in a single 768x768 input tile
+    'ai': OutputProfile('ai', (10, 8), 64, 'raster', None, None),
+}
+
+DEFAULT_PROFILE = OUTPUT_PROFILES['png']
+
+ENCODE_SECONDS = REGISTRY.histogram(
+    'botrader_chart_encode_seconds',
+    'Time to encode a chart image, by output profile',
+    labels=('profile',)
+)
+ENCODE_BYTES = REGISTRY.counter(
+    'botrader_chart_encode_bytes_total',
+    'Size of the encoded chart images by output profile, raw pixels for raster profiles',
+    labels=('profile',)
+)
+_last_encode = (0, 0.0)  # (bytes, seconds) of this process's last encode
+
+
+def candle_width(interval):
+    """Candle body width in days for a Binance interval such as '1m' or '1h'"""
+    if interval.endswith('m'):
+        min_interval = int(interval[:-1])
+    elif interval.endswith('h'):
+        min_interval = int(interval[:-1]) * 60
+    else:
+        min_interval = 1  # default
+    return (min_interval / 1440.0) * 0.8
+
+
+def frame_arrays(df):
+    """Extract (time, open, high, low, close, volume) float64 arrays from a kline DataFrame"""
+    t = date2num(df['open_time'].to_numpy())
+    o, h, l, c, v = (df[col].to_numpy(dtype=np.float64) for col in ('open', 'high', 'low', 'close', 'volume'))
+    return t, o, h, l, c, v
+
+
+def sma(close, window=SMA_WINDOW):
+    """Simple moving average aligned with `close`, NaN until the window is full"""
+    out = np.full(close.shape, np.nan)
+    if len(close) >= window:
+        csum = np.cumsum(np.insert(close, 0, 0.0))
+        out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+
+def bar_verts(x, bottom, top, width):
+    """Rectangle vertices (n, 4, 2) for bars centred on `x`"""
+    left = x - width / 2
+    right = x + width / 2
+    return np.stack([
+        np.column_stack([left, bottom]),
+        np.column_stack([left, top]),
+        np.column_stack([right, top]),
+        np.column_stack([right, bottom]),
+    ], axis=1)
+
+
+def candle_colors(o, c):
+    up = (c >= o)[:, None]
+    return np.where(up, COL_UP, COL_DOWN)
+
+
+def draw_candlestick(fig, t, o, h, l, c, v, coin_name, timeframe, interval):
+    """Draw the price and volume panels onto an empty figure"""
+    width = candle_width(interval)
+    colors = candle_colors(o, c)
+
+    ax1, ax2 = fig.subplots(2, 1, gridspec_kw={'height_ratios': [3, 1]}, sharex=True)
+
+    # Wicks below bodies, then bodies, each as one collection
+    wicks = np.stack([np.column_stack([t, l]), np.column_stack([t, h])], axis=1)
+    ax1.add_collection(LineCollection(wicks, colors=colors, linewidths=1))
+    bodies = bar_verts(t, np.minimum(o, c), np.maximum(o, c), width)
+    ax1.add_collection(PolyCollection(bodies, facecolors=colors, edgecolors='none'))
+    ax1.autoscale_view()
+
+    # Simple Moving Average (SMA 20)
+    if len(c) >= SMA_WINDOW:
+        ax1.plot(t, sma(c), color=COL_SMA, label='SMA 20')
+        ax1.legend()
+
+    ax1.set_title(f"{coin_name} Candlestick Chart ({timeframe})")
+    ax1.set_ylabel("Price (USD)")
+    ax1.grid(True)
+
+    # Volume
+    volume_bars = bar_verts(t, np.zeros_like(v), v, width)
+    ax2.add_collection(PolyCollection(volume_bars, facecolors=colors, edgecolors='none'))
+    ax2.autoscale_view()
+    ax2.set_ylim(bottom=0)
+    ax2.set_ylabel("Volume")
+    ax2.grid(True)
+
+    # X-axis formatting
+    ax2.xaxis_date()
+    ax2.xaxis.set_major_formatter(DateFormatter('%Y-%m-%d %H:%M'))
+    ax2.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+
+    return ax1, ax2
+
+
+def get_profile(profile):
+    """Accept an OutputProfile or the name of one in OUTPUT_PROFILES"""
+    if isinstance(profile, OutputProfile):
+        return profile
+    return OUTPUT_PROFILES[profile]
+
+
+def encode_figure(fig, profile=DEFAULT_PROFILE):
+    """Encode a drawn figure according to `profile` and return it as a BytesIO.
+
+    The raster format returns an RGB PIL image made from the canvas pixels instead.
+    """
+    started = time.perf_counter()
+    buf = BytesIO()
+
+    if profile.format == 'png':
+        fig.savefig(buf, format='png', dpi=profile.dpi)
+    else:
+        if fig.dpi != profile.dpi:
+            fig.set_dpi(profile.dpi)
+        fig.canvas.draw()
+        # A view of the canvas memory; convert() makes the only copy, which must
+        # outlive the canvas since templates redraw it on the next render
+        image = Image.frombuffer('RGBA', fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+        image = image.convert('RGB')
+        if profile.format == 'raster':
+            _record_encode(profile, image.width * image.height * 3, started)
+            return image
+        elif profile.format == 'png8':
+            image.quantize(colors=profile.colors, method=Image.Quantize.MEDIANCUT).save(buf, format='PNG', optimize=True)
+        elif profile.format == 'webp':
+            image.save(buf, format='WEBP', quality=profile.quality, method=4)
+        elif profile.format == 'jpeg':
+            image.save(buf, format='JPEG', quality=profile.quality, optimize=True)
+        else:
+            raise ValueError(f"Unknown image format: {profile.format}")
+
+    _record_encode(profile, buf.tell(), started)
+    buf.seek(0)
+    return buf
+
+
+def _record_encode(profile, size, started):
+    global _last_encode
+    seconds = time.perf_counter() - started
+    # Render processes hand it back to the parent, whose metrics are the ones served
+    _last_encode = (size, seconds)
+    observe_encode(profile.name, size, seconds)
+
+
+def observe_encode(profile_name, size, seconds):
+    STAGE_SECONDS.observe(seconds, stage='encode')
+    ENCODE_SECONDS.observe(seconds, profile=profile_name)
+    ENCODE_BYTES.inc(size, profile=profile_name)
+
+
+def composite_image(images, background='white'):
+    """Stack chart images top to bottom into one RGB image"""
+    width = max(image.width for image in images)
+    composite = Image.new('RGB', (width, sum(image.height for image in images)), background)
+    y = 0
+    for image in images:
+        composite.paste(image, (0, y))
+        y += image.height
+    return composite
+
+
+def render_arrays(t, o, h, l, c, v, coin_name, timeframe, interval, profile=DEFAULT_PROFILE):
+    """Render a candlestick chart from kline arrays on a new figure, returns the image as a BytesIO"""
+    profile = get_profile(profile)
+    fig = Figure(figsize=profile.figsize, dpi=profile.dpi)
+    FigureCanvasAgg(fig)
+    draw_candlestick(fig, t, o, h, l, c, v, coin_name, timeframe, interval)
+    return encode_figure(fig, profile)
+
+
+class FigureTemplate:
+    """A laid-out chart figure that is refilled with new candles on every render.
+
+    Axes, grid, legend, date formatter and the subplot layout are set up once;
+    a render only swaps the vertices and colors of the candle, SMA and volume
+    artists, sets the axis limits and encodes the image.
+    """
+
+    def __init__(self, timeframe, interval, figsize=(10, 8), dpi=100):
+        self.timeframe = timeframe
+        self.width = candle_width(interval)
+        self.lock = threading.Lock()
+
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax1, self.ax2 = self.fig.subplots(2, 1, gridspec_kw={'height_ratios': [3, 1]}, sharex=True)
+
+        self.wicks = LineCollection([], linewidths=1)
+        self.bodies = PolyCollection([], edgecolors='none')
+        self.volume = PolyCollection([], edgecolors='none')
+        self.ax1.add_collection(self.wicks)
+        self.ax1.add_collection(self.bodies)
+        self.ax2.add_collection(self.volume)
+        self.sma_line, = self.ax1.plot([], [], color=COL_SMA, label='SMA 20')
+        self.legend = self.ax1.legend()
+
+        self.ax1.set_ylabel("Price (USD)")
+        self.ax1.grid(True)
+        self.ax2.set_ylabel("Volume")
+        self.ax2.grid(True)
+        self.ax2.xaxis_date()
+        self.ax2.xaxis.set_major_formatter(DateFormatter('%Y-%m-%d %H:%M'))
+        self.ax2.tick_params(axis='x', labelrotation=45)
+
+        # Lay out once around six-digit prices, the widest labels we expect
+        step = self.width / 0.8
+        t = 19723.0 + np.arange(SMA_WINDOW) * step
+        prices = np.linspace(100000.0, 120000.0, SMA_WINDOW)
+        self.update(t, prices, prices, prices, prices, prices * 10, "Bitcoin (BTC)")
+        self.fig.tight_layout()
+
+    def update(self, t, o, h, l, c, v, coin_name):
+        """Swap in new candles, SMA and volume and set the axis limits"""
+        colors = candle_colors(o, c)
+        width = self.width
+
+        self.wicks.set_segments(np.stack([np.column_stack([t, l]), np.column_stack([t, h])], axis=1))
+        self.wicks.set_color(colors)
+        self.bodies.set_verts(bar_verts(t, np.minimum(o, c), np.maximum(o, c), width))
+        self.bodies.set_facecolor(colors)
+        self.volume.set_verts(bar_verts(t, np.zeros_like(v), v, width))
+        self.volume.set_facecolor(colors)
+
+        has_sma = len(c) >= SMA_WINDOW
+        if has_sma:
+            self.sma_line.set_data(t, sma(c))
+        self.sma_line.set_visible(has_sma)
+        self.legend.set_visible(has_sma)
+
+        self.ax1.set_title(f"{coin_name} Candlestick Chart ({self.timeframe})")
+
+        # Same 5% margins autoscale_view would add, without walking the artists
+        x0, x1 = t[0] - width / 2, t[-1] + width / 2
+        xpad = (x1 - x0) * 0.05 or 1.0
+        self.ax2.set_xlim(x0 - xpad, x1 + xpad)
+        y0, y1 = np.min(l), np.max(h)
+        ypad = (y1 - y0) * 0.05 or abs(y1) * 0.05 or 1.0
+        self.ax1.set_ylim(y0 - ypad, y1 + ypad)
+        self.ax2.set_ylim(0, (np.max(v) * 1.05) or 1.0)
+
+    def render(self, t, o, h, l, c, v, coin_name, profile=DEFAULT_PROFILE):
+        with self.lock:
+            self.update(t, o, h, l, c, v, coin_name)
+            return encode_figure(self.fig, profile)
+
+
+class FigureTemplateCache:
+    """One FigureTemplate per (timeframe, interval, figsize, dpi), created on first use"""
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, timeframe, interval, figsize=(10, 8), dpi=100):
+        key = (timeframe, interval, tuple(figsize), dpi)
+        template = self._templates.get(key)
+        if template is None:
+            with self._lock:
+                template = self._templates.get(key)
+                if template is None:
+                    template = self._templates[key] = FigureTemplate(timeframe, interval, figsize, dpi)
+        return template
+
+
+templates = FigureTemplateCache()
+
+
+def render_template(t, o, h, l, c, v, coin_name, timeframe, interval, profile=DEFAULT_PROFILE):
+    """Render a candlestick chart by refilling the cached figure for its timeframe"""
+    profile = get_profile(profile)
+    template = templates.get(timeframe, interval, profile.figsize, profile.dpi)
+    return template.render(t, o, h, l, c, v, coin_name, profile)
+
+
+def render_candlestick(df, coin_name, timeframe, interval, profile=DEFAULT_PROFILE):
+    """Render a candlestick chart with volume and SMA 20 from a kline DataFrame"""
+    return render_template(*frame_arrays(df), coin_name, timeframe, interval, profile)
+
+
+def pack_arrays(t, o, h, l, c, v):
+    """Pack kline arrays into one contiguous float64 buffer for another process"""
+    return np.stack([t, o, h, l, c, v]).astype(np.float64, copy=False).tobytes()
+
+
+def unpack_arrays(buf):
+    """Inverse of pack_arrays, returns the six arrays as read-only views of `buf`"""
+    return tuple(np.frombuffer(buf, dtype=np.float64).reshape(6, -1))
+
+
+def _warm_worker():
+    # Pay for the matplotlib import, font cache and Agg setup before the first real chart
+    n = SMA_WINDOW + 1
+    t = np.arange(n, dtype=np.float64) + 19723.0
+    prices = np.linspace(1.0, 2.0, n)
+    render_arrays(t, prices, prices + 0.1, prices - 0.1, prices, prices, "warmup", "1h", "1m")
+
+
+def _render_packed(buf, coin_name, timeframe, interval, profile):
+    image = render_template(*unpack_arrays(buf), coin_name, timeframe, interval, profile)
+    if isinstance(image, Image.Image):
+        # Raster profiles send the pixels back, the parent rebuilds the image from them
+        return (image.mode, image.size, image.tobytes()), _last_encode
+    return image.getvalue(), _last_encode
+
+
+class ProcessRenderer:
+    """Render charts in a pool of pre-warmed worker processes.
+
+    Matplotlib holds the GIL while drawing and encoding, so threads cannot
+    render on more than one core. Klines cross the process boundary as one
+    packed float64 buffer and the PNG comes back as bytes (a raster image as
+    its mode, size and pixels), no DataFrame is ever pickled. The encode
+    size and time come back with it for this process's metrics.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        # Spawned workers start clean instead of inheriting the bot's threads and sockets
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_worker
+        )
+        # Start every worker now so the first charts don't pay for the spawn and warm up
+        wait([self._executor.submit(os.getpid) for _ in range(processes)])
+
+    def render(self, df, coin_name, timeframe, interval, profile=DEFAULT_PROFILE):
+        buf = pack_arrays(*frame_arrays(df))
+        profile = get_profile(profile)
+        image, (size, seconds) = self._executor.submit(
+            _render_packed, buf, coin_name, timeframe, interval, profile
+        ).result()
+        observe_encode(profile.name, size, seconds)
+        if isinstance(image, tuple):
+            return Image.frombytes(*image)
+        return BytesIO(image)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
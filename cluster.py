@@ -0,0 +1,250 @@
+"""Multi-process entry point for the Crypto Tracker Bot.
+
+One intake process receives every update, by long polling or through the
+webhook server, and shards them by chat over local queues to
+CLUSTER_WORKERS worker processes running bot.py's handlers. A chat always
+lands on the same worker, which handles its updates one at a time in
+arrival order and keeps its per-chat state. A supervisor thread replaces
+workers that die, carrying over what was still queued for them. The intake
+also polls the bulk ticker for all of them, through shared memory. Start it
+with `python cluster.py` instead of `python bot.py`.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+from binance_api import SharedTickers
+from metrics import METRICS_PORT, REGISTRY, log_error, log_event, start_server
+
+CLUSTER_WORKERS = int(os.environ.get("CLUSTER_WORKERS", os.cpu_count() or 1))
+# "polling" or "webhook", the latter configured like webhook.py
+CLUSTER_INTAKE = os.environ.get("CLUSTER_INTAKE", "polling")
+CLUSTER_QUEUE_SIZE = int(os.environ.get("CLUSTER_QUEUE_SIZE", 1000))
+
+# Update fields that carry the chat, or at least the user, an update belongs to
+UPDATE_CHAT_PATHS = (
+    ('message', 'chat'),
+    ('edited_message', 'chat'),
+    ('channel_post', 'chat'),
+    ('edited_channel_post', 'chat'),
+    ('callback_query', 'message', 'chat'),
+    ('callback_query', 'from'),
+    ('my_chat_member', 'chat'),
+    ('chat_member', 'chat'),
+    ('chat_join_request', 'chat'),
+    ('inline_query', 'from'),
+    ('chosen_inline_result', 'from'),
+    ('shipping_query', 'from'),
+    ('pre_checkout_query', 'from'),
+    ('poll_answer', 'user'),
+)
+
+
+def update_chat_id(update):
+    """Chat (or user) id of a raw update dict, 0 for updates without one such as polls"""
+    for path in UPDATE_CHAT_PATHS:
+        value = update
+        for field in path:
+            value = value.get(field) if isinstance(value, dict) else None
+        if isinstance(value, dict) and 'id' in value:
+            return value['id']
+    return 0
+
+
+def shard_for(chat_id, shards):
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def worker_main(index, updates, tickers=None):
+    """Run bot.py's handlers on the updates of one shard, in arrival order"""
+    # The intake process stops the workers through their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The workers share one IP and so one Binance weight limit, start from an even split
+    os.environ.setdefault("BINANCE_WEIGHT_LIMIT", str(6000 // CLUSTER_WORKERS))
+    # Telegram's global send limit is per bot, split it the same way
+    os.environ.setdefault("TELEGRAM_RATE", str(30 / CLUSTER_WORKERS))
+    # A chat always lands on the same worker, so each worker can keep its own AI cache file
+    ai_cache_path = os.environ.get("AI_CACHE_PATH", "data/ai_cache.json")
+    if ai_cache_path:
+        root, ext = os.path.splitext(ai_cache_path)
+        os.environ["AI_CACHE_PATH"] = f"{root}.{index}{ext}"
+
+    import bot as app
+
+    # Handle each update on this thread before taking the next one, so a chat's
+    # updates never overtake each other; slow jobs still go to the job pools
+    app.bot.threaded = False
+    app.start_process_renderer()
+    if tickers is not None:
+        # The intake process polls the bulk ticker for every worker
+        app.ticker_snapshot = tickers
+    app.ticker_snapshot.start()
+    # Each worker has its own metrics, served on the ports after the intake's
+    app.start_metrics_server(port=METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    app.logger.info(f"Cluster worker {index} started (pid {os.getpid()})")
+
+    while True:
+        raw = updates.get()
+        if raw is None:
+            break
+        try:
+            app.bot.process_new_updates([app.types.Update.de_json(raw)])
+        except Exception as e:
+            log_error('cluster_worker', e, worker=index)
+
+    app.slow_jobs.shutdown()
+    app.send_queue.close()
+
+
+class UpdateRouter:
+    """Shard raw updates by chat to worker processes and keep those processes alive"""
+
+    def __init__(self, workers=CLUSTER_WORKERS, queue_size=CLUSTER_QUEUE_SIZE, target=worker_main, check_interval=1.0,
+                 worker_args=()):
+        self.size = workers
+        self.queue_size = queue_size
+        self.target = target
+        self.check_interval = check_interval
+        self.worker_args = tuple(worker_args)  # passed to `target` after the index and queue
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [None] * workers  # (process, queue) per shard
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._supervisor = None
+
+    def start(self):
+        for index in range(self.size):
+            self._workers[index] = self._spawn(index, self._context.Queue(self.queue_size))
+        self._supervisor = threading.Thread(target=self._supervise, name='cluster-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def submit(self, update):
+        """Queue a raw update dict on its chat's worker, returns False if that queue is full"""
+        index = shard_for(update_chat_id(update), self.size)
+        with self._lock:
+            _, updates = self._workers[index]
+            try:
+                updates.put_nowait(json.dumps(update))
+            except queue.Full:
+                return False
+        return True
+
+    def alive(self):
+        """Number of worker processes currently running"""
+        with self._lock:
+            return sum(process.is_alive() for process, _ in self._workers)
+
+    def shutdown(self, timeout=10):
+        self._stopping.set()
+        with self._lock:
+            workers = list(self._workers)
+        for process, updates in workers:
+            updates.put(None)
+        for process, _ in workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def _spawn(self, index, updates):
+        process = self._context.Process(
+            target=self.target,
+            args=(index, updates, *self.worker_args),
+            name=f'cluster-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        return process, updates
+
+    def _supervise(self):
+        while not self._stopping.wait(self.check_interval):
+            for index in range(self.size):
+                process, updates = self._workers[index]
+                if process.is_alive() or self._stopping.is_set():
+                    continue
+
+                log_event('cluster_worker_exited', logging.WARNING, worker=index, pid=process.pid, exitcode=process.exitcode)
+                with self._lock:
+                    # Carry the backlog over to a fresh queue, the dead process may
+                    # have left the old one's read lock held
+                    replacement = self._context.Queue(self.queue_size)
+                    backlog = 0
+                    while True:
+                        try:
+                            replacement.put_nowait(updates.get(timeout=0.1))
+                            backlog += 1
+                        except (queue.Empty, queue.Full):
+                            break
+                    self._workers[index] = self._spawn(index, replacement)
+                    self.restarts += 1
+                if backlog:
+                    log_event('cluster_backlog_moved', worker=index, updates=backlog)
+
+
+def poll_updates(router, timeout=20):
+    """Long poll Telegram and route every update, waiting while a worker's queue is full"""
+    from telebot import apihelper
+
+    import bot as app
+
+    offset = None
+    while True:
+        try:
+            updates = apihelper.get_updates(app.API_TOKEN, offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception as e:
+            log_error('polling', e)
+            time.sleep(3)
+            continue
+
+        for update in updates:
+            while not router.submit(update):
+                time.sleep(0.1)
+            offset = update['update_id'] + 1
+
+
+def main():
+    import bot as app
+
+    # One bulk ticker poll for the whole cluster, published to every worker
+    tickers = SharedTickers(app.coins.symbols(), multiprocessing.get_context('spawn'))
+    app.ticker_snapshot.on_refresh = tickers.publish
+    app.ticker_snapshot.start()
+
+    router = UpdateRouter(worker_args=(tickers,))
+    router.start()
+    REGISTRY.gauge('botrader_cluster_workers_alive', 'Cluster worker processes running', router.alive)
+    REGISTRY.gauge('botrader_cluster_restarts_total', 'Cluster workers replaced after dying', lambda: router.restarts, kind='counter')
+    start_server()
+    log_event('cluster_started', workers=router.size, intake=CLUSTER_INTAKE)
+
+    # Once for the whole cluster, workers pick the new snapshot up when they restart
+    app.start_exchange_info_refresh()
+
+    try:
+        if CLUSTER_INTAKE == 'webhook':
+            import webhook
+
+            if not webhook.WEBHOOK_SECRET:
+                raise SystemExit("WEBHOOK_SECRET must be set for the webhook intake")
+            if webhook.WEBHOOK_URL:
+                webhook.app.bot.set_webhook(url=webhook.WEBHOOK_URL, secret_token=webhook.WEBHOOK_SECRET)
+            server = webhook.create_server(dispatcher=router, decode=json.loads)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+        else:
+            app.bot.remove_webhook()
+            poll_updates(router)
+    finally:
+        router.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Compact numeric summaries of kline frames, the text alternative to chart images"""
+import json
+
+import numpy as np
+
+# The same SMA the chart draws, so the numbers and the picture agree
+from charts import SMA_WINDOW, sma
+
+RECENT_CANDLES = 5
+MAX_CROSSOVERS = 3
+
+
+def _num(x, digits=6):
+    """Round to `digits` significant digits so the JSON stays short"""
+    return float(f"{x:.{digits}g}")
+
+
+def _pct(new, old):
+    return _num((new - old) / old * 100, 3) if old else 0.0
+
+
+def candle_patterns(o, h, l, c):
+    """Names of the classic one- and two-candle patterns formed by the last candle"""
+    body = abs(c[-1] - o[-1])
+    span = h[-1] - l[-1]
+    if span <= 0:
+        return []
+
+    upper = h[-1] - max(o[-1], c[-1])
+    lower = min(o[-1], c[-1]) - l[-1]
+    patterns = []
+
+    if body <= span * 0.1:
+        patterns.append('doji')
+    elif body >= span * 0.9:
+        patterns.append('bullish marubozu' if c[-1] > o[-1] else 'bearish marubozu')
+    elif lower >= body * 2 and upper <= body:
+        patterns.append('hammer')
+    elif upper >= body * 2 and lower <= body:
+        patterns.append('shooting star')
+
+    if len(c) > 1:
+        prev_low, prev_high = min(o[-2], c[-2]), max(o[-2], c[-2])
+        if c[-2] < o[-2] and c[-1] > o[-1] and o[-1] <= prev_low and c[-1] >= prev_high:
+            patterns.append('bullish engulfing')
+        elif c[-2] > o[-2] and c[-1] < o[-1] and o[-1] >= prev_high and c[-1] <= prev_low:
+            patterns.append('bearish engulfing')
+
+    return patterns
+
+
+def sma_crossovers(t, c, sma):
+    """Most recent closes across the SMA, newest last, as (time, 'above'/'below')"""
+    valid = ~np.isnan(sma)
+    side = np.where(c[valid] >= sma[valid], 1, -1)
+    times = t[valid]
+    flips = np.flatnonzero(np.diff(side)) + 1
+    return int(len(flips)), [
+        (str(times[i]), 'above' if side[i] > 0 else 'below')
+        for i in flips[-MAX_CROSSOVERS:]
+    ]
+
+
+def timeframe_features(df, interval):
+    """OHLC statistics, SMA20 position and crossovers, volume trend and recent candles"""
+    t = df['open_time'].dt.strftime('%Y-%m-%d %H:%M').to_numpy()
+    o = df['open'].to_numpy(dtype=float)
+    h = df['high'].to_numpy(dtype=float)
+    l = df['low'].to_numpy(dtype=float)
+    c = df['close'].to_numpy(dtype=float)
+    v = df['volume'].to_numpy(dtype=float)
+
+    features = {
+        'interval': interval,
+        'candles': len(df),
+        'from': t[0],
+        'to': t[-1],
+        'open': _num(o[0]),
+        'close': _num(c[-1]),
+        'high': _num(h.max()),
+        'low': _num(l.min()),
+        'change_pct': _pct(c[-1], o[0]),
+        'range_pct': _pct(h.max(), l.min()),
+        'volatility_pct': _num(np.std(np.diff(np.log(c))) * 100, 3) if len(c) > 1 else 0.0,
+        'up_candles': int((c >= o).sum()),
+    }
+
+    if len(c) >= SMA_WINDOW:
+        average = sma(c)
+        count, recent = sma_crossovers(t, c, average)
+        features['sma20'] = {
+            'last': _num(average[-1]),
+            'close_vs_sma_pct': _pct(c[-1], average[-1]),
+            'slope_pct': _pct(average[-1], average[-SMA_WINDOW]) if len(c) >= 2 * SMA_WINDOW - 1 else None,
+            'crossovers': count,
+            'recent_crossovers': recent,
+        }
+
+    half = len(v) // 2
+    up_volume = v[c >= o].sum()
+    features['volume'] = {
+        'total': _num(v.sum()),
+        'last_vs_avg': _num(v[-1] / v.mean(), 3) if v.mean() else 0.0,
+        'second_half_vs_first_pct': _pct(v[half:].mean(), v[:half].mean()) if half else 0.0,
+        'up_volume_share': _num(up_volume / v.sum(), 3) if v.sum() else 0.0,
+    }
+
+    features['recent_candles'] = [
+        [t[i], _num(o[i]), _num(h[i]), _num(l[i]), _num(c[i]), _num(v[i], 4)]
+        for i in range(max(0, len(c) - RECENT_CANDLES), len(c))
+    ]
+    features['last_candle_patterns'] = candle_patterns(o, h, l, c)
+
+    return features
+
+
+def market_summary(frames):
+    """JSON summary of {timeframe: (interval, df)}, in the order given"""
+    return json.dumps(
+        {timeframe: timeframe_features(df, interval) for timeframe, (interval, df) in frames.items()},
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
@@ -0,0 +1,286 @@
+"""Latency histograms, counters and gauges for the bot, plus structured JSON event logs.
+
+Metrics live in one process-wide registry and are served in the Prometheus
+text format by a small local HTTP server (`start_server`). Events are logged
+as one JSON object per line, tagged with the request ID of the callback that
+caused them; the ID lives in a context variable, so it follows a callback
+into the job it queues and across awaits in the asyncio engine.
+"""
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# 0 turns the endpoint off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+
+# Seconds, from a cache hit to a slow Gemini answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A count that only goes up, per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _label_text(self.labels, key), value) for key, value in values.items()]
+
+
+class Histogram:
+    """Observed durations counted into cumulative `le` buckets, per combination of label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the `with` block took"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', _label_text(self.labels, key, [('le', _number(bound))]), cumulative))
+            samples.append((f'{self.name}_sum', _label_text(self.labels, key), counts[-1]))
+            samples.append((f'{self.name}_count', _label_text(self.labels, key), cumulative))
+        return samples
+
+
+class Gauge:
+    """A value read when the metrics are scraped, from `read()`.
+
+    `read` returns a number, or {label value or tuple of them: number} for a
+    gauge with labels. `kind` may be set to 'counter' for totals that are kept
+    elsewhere, such as a cache's hit count.
+    """
+
+    def __init__(self, name, help, read, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        try:
+            values = self.read()
+        except Exception as e:
+            log_error('metrics', e, metric=self.name)
+            return []
+        if not self.labels:
+            return [(self.name, '', values)]
+        return [
+            (self.name, _label_text(self.labels, key if isinstance(key, tuple) else (key,)), value)
+            for key, value in values.items()
+            if value is not None
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, or return the one already registered under its name"""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read, labels=(), kind='gauge'):
+        """Register a gauge read from `read()`; registering the name again replaces it"""
+        metric = Gauge(name, help, read, labels, kind)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Shared by every module, so each stage is one `stage` label of the same histogram
+STAGE_SECONDS = REGISTRY.histogram(
+    'botrader_stage_seconds',
+    'Time spent in each stage of a chart or AI request',
+    labels=('stage',)
+)
+CALLBACK_SECONDS = REGISTRY.histogram(
+    'botrader_callback_seconds',
+    'Time from a button press to the last queued reply, by action',
+    labels=('action',)
+)
+CALLBACKS = REGISTRY.counter(
+    'botrader_callbacks_total',
+    'Button presses handled, by action and outcome',
+    labels=('action', 'outcome')
+)
+ERRORS = REGISTRY.counter(
+    'botrader_errors_total',
+    'Errors logged, by where they happened',
+    labels=('where',)
+)
+
+
+# Structured logs
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+events = logging.getLogger('botrader')
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, event, request ID and the event's fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _configure_events():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    events.addHandler(handler)
+    events.setLevel(logging.INFO)
+    events.propagate = False
+
+
+_configure_events()
+
+
+def new_request_id():
+    """Start a request: make a new ID the current one and return it"""
+    request_id = uuid.uuid4().hex[:12]
+    _request_id.set(request_id)
+    return request_id
+
+
+def request_id():
+    return _request_id.get()
+
+
+def log_event(event, level=logging.INFO, **fields):
+    events.log(level, event, extra={'request_id': _request_id.get(), 'fields': fields})
+
+
+def log_error(where, error, **fields):
+    """Count an error and log it as an event, in place of a bare print"""
+    ERRORS.inc(where=where)
+    log_event('error', logging.ERROR, where=where, error=str(error), error_type=type(error).__name__, **fields)
+
+
+# Local /metrics endpoint
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics on a daemon thread, returns the server or None if METRICS_PORT is 0"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log_event('metrics_server_started', address=f"{host}:{server.server_address[1]}")
+    return server
@@ -0,0 +1,344 @@
+"""Outbound Telegram calls, paced for Telegram's flood limits and kept in order per chat"""
+import asyncio
+import contextvars
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import REGISTRY, log_error
+
+# Priority lanes, lowest first: what the user is looking at before new messages before uploads
+URGENT = 0
+NORMAL = 1
+BULK = 2
+
+# Lane of each bot method the queue sends for the handlers
+METHOD_PRIORITIES = {
+    'answer_callback_query': URGENT,
+    'answer_pre_checkout_query': URGENT,
+    'edit_message_text': URGENT,
+    'edit_message_reply_markup': URGENT,
+    'delete_message': URGENT,
+    'send_message': NORMAL,
+    'reply_to': NORMAL,
+    'send_invoice': NORMAL,
+    'send_photo': BULK,
+}
+
+# Answers to queries go to a user, not into a chat, and need no ordering
+UNORDERED_METHODS = {'answer_callback_query', 'answer_pre_checkout_query'}
+
+CALL_SECONDS = REGISTRY.histogram(
+    'botrader_telegram_call_seconds',
+    'Telegram API call latency by method, send_photo includes the upload',
+    labels=('method',)
+)
+CALLS = REGISTRY.counter(
+    'botrader_telegram_calls_total',
+    'Telegram API calls by method and outcome: ok, error or retried after a 429',
+    labels=('method', 'outcome')
+)
+
+
+def telegram_retry_after(e):
+    """Seconds Telegram asked us to wait in a 429 error, 0 for other errors"""
+    if getattr(e, 'error_code', None) != 429:
+        return 0
+    result = e.result_json if isinstance(e.result_json, dict) else {}
+    return result.get('parameters', {}).get('retry_after', 1)
+
+
+def is_not_modified(e):
+    """An edit that would leave the message as it is, harmless"""
+    return getattr(e, 'error_code', None) == 400 and 'message is not modified' in str(e)
+
+
+class TokenBucket:
+    """`rate` calls per second on average, up to `burst` at once"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until a call may be made, 0 if one may be made now"""
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ('key', 'chat_id', 'method', 'args', 'kwargs', 'priority', 'seq', 'future', 'attempts', 'context')
+
+    def __init__(self, key, chat_id, method, args, kwargs, priority, seq):
+        self.key = key
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = Future()
+        self.attempts = 0
+        # Run with the submitter's context, so logs carry its request ID
+        self.context = contextvars.copy_context()
+
+
+class _Chat:
+    __slots__ = ('jobs', 'busy', 'bucket', 'paused_until')
+
+    def __init__(self, bucket):
+        self.jobs = deque()
+        self.busy = False
+        self.bucket = bucket
+        self.paused_until = 0
+
+
+class SendQueue:
+    """Runs Telegram calls on a few threads within a global and a per-chat rate.
+
+    Each chat's calls run one at a time in the order they were queued, so a
+    chart, the message deleted after it and the menu sent after that always
+    arrive as sent. Between chats, the next call is taken from the lowest
+    priority lane that has one ready. A 429 pauses the chat (the whole queue
+    for calls outside a chat) for its retry_after and puts the call back at
+    the head of its chat's queue, up to `max_retries` times.
+    """
+
+    def __init__(self, rate=30, chat_rate=1.0, chat_burst=3, workers=8, max_retries=3):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.pending = 0
+        self.retries = 0
+        self._bucket = TokenBucket(rate, max(rate, 1))
+        self._paused_until = 0
+        self._chats = {}  # chat_id, or a per-call key for unordered calls -> _Chat
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='send')
+        self._dispatcher = threading.Thread(target=self._dispatch, name='send-dispatcher', daemon=True)
+        self._dispatcher.start()
+        # concurrent.futures shuts its executors down at exit before atexit handlers run,
+        # drain the queue before that while the send threads still take work
+        threading._register_atexit(self.close)
+
+    def submit(self, chat_id, method, /, *args, priority=NORMAL, ordered=True, **kwargs):
+        """Queue `method(*args, **kwargs)` for `chat_id` and return a Future of its result"""
+        with self._cond:
+            seq = next(self._seq)
+            key = chat_id if ordered and chat_id is not None else ('unordered', seq)
+            job = _Job(key, chat_id, method, args, kwargs, priority, seq)
+            chat = self._chats.get(key)
+            if chat is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst) if key == chat_id else None
+                chat = self._chats[key] = _Chat(bucket)
+            chat.jobs.append(job)
+            self.pending += 1
+            self._cond.notify()
+        return job.future
+
+    def close(self, timeout=5):
+        """Stop taking calls and give the queued ones up to `timeout` seconds to go out"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._dispatcher.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                if self._closed and not self.pending and not any(chat.busy for chat in self._chats.values()):
+                    return
+                job, wait = self._next_job(time.monotonic())
+                if job is None:
+                    self._cond.wait(wait)
+                    continue
+                try:
+                    self._executor.submit(job.context.run, self._run, job)
+                except RuntimeError:
+                    # The executor is shut down already, send what is left from this thread
+                    self._cond.release()
+                    try:
+                        job.context.run(self._run, job)
+                    finally:
+                        self._cond.acquire()
+
+    def _next_job(self, now):
+        """Take the next call that may go out now, or return (None, seconds to wait)"""
+        wait = max(self._paused_until - now, self._bucket.delay(now))
+        if wait > 0:
+            return None, wait
+
+        best = None
+        wait = None
+        for key, chat in list(self._chats.items()):
+            if chat.busy:
+                continue
+            if not chat.jobs:
+                if chat.bucket is None or chat.bucket.full(now):
+                    del self._chats[key]
+                continue
+            delay = max(chat.paused_until - now, chat.bucket.delay(now) if chat.bucket else 0)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = chat.jobs[0]
+            if best is None or (head.priority, head.seq) < (best.jobs[0].priority, best.jobs[0].seq):
+                best = chat
+
+        if best is None:
+            return None, wait
+
+        job = best.jobs.popleft()
+        best.busy = True
+        self._bucket.take()
+        if best.bucket is not None:
+            best.bucket.take()
+        self.pending -= 1
+        return job, 0
+
+    def _run(self, job):
+        # Retried calls are running already
+        if not job.attempts and not job.future.set_running_or_notify_cancel():
+            self._finish(job)
+            return
+
+        name = getattr(job.method, '__name__', 'call')
+        started = time.perf_counter()
+        try:
+            result = job.method(*job.args, **job.kwargs)
+        except Exception as e:
+            CALL_SECONDS.observe(time.perf_counter() - started, method=name)
+            retry_after = telegram_retry_after(e)
+            if retry_after and job.attempts < self.max_retries:
+                CALLS.inc(method=name, outcome='retried')
+                job.attempts += 1
+                self._retry(job, retry_after)
+                return
+            CALLS.inc(method=name, outcome='error')
+            if not is_not_modified(e):
+                log_error('telegram', e, method=name, chat_id=job.chat_id)
+            self._finish(job)
+            job.future.set_exception(e)
+        else:
+            CALL_SECONDS.observe(time.perf_counter() - started, method=name)
+            CALLS.inc(method=name, outcome='ok')
+            self._finish(job)
+            job.future.set_result(result)
+
+    def _retry(self, job, retry_after):
+        # Rewind uploads so the retry sends the whole file again
+        for value in (*job.args, *job.kwargs.values()):
+            if hasattr(value, 'seek'):
+                value.seek(0)
+        with self._cond:
+            chat = self._chats[job.key]
+            until = time.monotonic() + retry_after
+            if job.key == job.chat_id:
+                chat.paused_until = max(chat.paused_until, until)
+            else:
+                self._paused_until = max(self._paused_until, until)
+            chat.jobs.appendleft(job)
+            chat.busy = False
+            self.pending += 1
+            self.retries += 1
+            self._cond.notify()
+
+    def _finish(self, job):
+        with self._cond:
+            self._chats[job.key].busy = False
+            self._cond.notify()
+
+
+class Outbox:
+    """Bot methods that queue their call on a SendQueue and return a Future at once.
+
+    `outbox.send_message(chat_id, text)` takes the arguments of
+    `bot.send_message`; the chat and the priority lane follow from the method.
+    Call `.result()` on the Future when the sent message is needed.
+    """
+
+    def __init__(self, bot, queue):
+        self.bot = bot
+        self.queue = queue
+
+    def __getattr__(self, name):
+        if name not in METHOD_PRIORITIES:
+            raise AttributeError(name)
+        method = getattr(self.bot, name)
+        priority = METHOD_PRIORITIES[name]
+        ordered = name not in UNORDERED_METHODS
+
+        def submit(*args, **kwargs):
+            return self.queue.submit(call_chat_id(name, args, kwargs), method, *args,
+                                     priority=priority, ordered=ordered, **kwargs)
+        return submit
+
+
+class AsyncOutbox:
+    """Outbox for AsyncTeleBot: its calls go through the same SendQueue and return awaitables.
+
+    The queue's thread runs each coroutine on the event loop it was queued
+    from and waits for it, so pacing, lanes, per-chat order and 429 retries
+    are the same as for the sync bot. Awaiting the result is optional, the
+    queue logs the errors of calls nobody waits for.
+    """
+
+    def __init__(self, bot, queue):
+        self.bot = bot
+        self.queue = queue
+
+    def __getattr__(self, name):
+        if name not in METHOD_PRIORITIES:
+            raise AttributeError(name)
+        method = getattr(self.bot, name)
+        priority = METHOD_PRIORITIES[name]
+        ordered = name not in UNORDERED_METHODS
+
+        def submit(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+
+            def call(*args, **kwargs):
+                # A fresh coroutine per attempt, so a retry after a 429 makes the call again
+                return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), loop).result()
+            call.__name__ = name
+
+            future = asyncio.wrap_future(
+                self.queue.submit(call_chat_id(name, args, kwargs), call, *args,
+                                  priority=priority, ordered=ordered, **kwargs),
+                loop=loop
+            )
+            future.add_done_callback(_retrieve)
+            return future
+        return submit
+
+
+def _retrieve(future):
+    # Mark the error as seen, asyncio would warn about every call that was not awaited
+    if not future.cancelled():
+        future.exception()
+
+
+def call_chat_id(name, args, kwargs):
+    """Chat a bot method call goes to, None for answers to queries"""
+    if name in UNORDERED_METHODS:
+        return None
+    if name == 'reply_to':
+        return args[0].chat.id
+    return kwargs['chat_id'] if 'chat_id' in kwargs else args[0]
@@ -0,0 +1,241 @@
+"""Per-chat user preferences that survive restarts"""
+import atexit
+import dbm
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from metrics import log_error
+
+
+class MemoryBackend:
+    """Keeps nothing across restarts, for tests and throwaway runs"""
+
+    def __init__(self):
+        self._rows = {}
+
+    def load(self, chat_id):
+        return dict(self._rows.get(chat_id, {}))
+
+    def save_many(self, rows):
+        for chat_id, key, value in rows:
+            self._rows.setdefault(chat_id, {})[key] = value
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """Preferences in an embedded SQLite database in WAL mode.
+
+    WAL lets several processes (see cluster.py) read while one writes, and
+    synchronous=NORMAL only syncs at checkpoints, which is plenty for settings.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS preferences ("
+                " chat_id INTEGER NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " PRIMARY KEY (chat_id, key)"
+                ") WITHOUT ROWID"
+            )
+            self._db.commit()
+
+    def load(self, chat_id):
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM preferences WHERE chat_id = ?", (chat_id,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_many(self, rows):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO preferences (chat_id, key, value) VALUES (?, ?, ?)",
+                [(chat_id, key, json.dumps(value)) for chat_id, key, value in rows]
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class KeyValueBackend:
+    """Local stand-in for a networked key-value store, one JSON record per chat in a dbm file"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = dbm.open(path, 'c')
+        self._lock = threading.Lock()
+
+    def load(self, chat_id):
+        with self._lock:
+            record = self._db.get(str(chat_id))
+        return json.loads(record) if record else {}
+
+    def save_many(self, rows):
+        updates = {}
+        for chat_id, key, value in rows:
+            updates.setdefault(chat_id, {})[key] = value
+        with self._lock:
+            for chat_id, values in updates.items():
+                record = self._db.get(str(chat_id))
+                merged = json.loads(record) if record else {}
+                merged.update(values)
+                self._db[str(chat_id)] = json.dumps(merged)
+            if hasattr(self._db, 'sync'):
+                self._db.sync()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'kv': KeyValueBackend,
+}
+
+
+class PreferenceStore:
+    """Per-chat preferences with a read-through LRU cache and write-behind batching.
+
+    A chat's preferences are read from the backend the first time the chat is
+    seen and answered from memory after that, so a lookup is a couple of dict
+    accesses; the `max_chats` most recently seen chats are kept. Writes go to
+    memory at once and reach the backend in batches, every `flush_interval`
+    seconds and on exit. The backend is only opened, and the flush thread only
+    started, when the store is first used, so importing the bot touches no files.
+    """
+
+    def __init__(self, open_backend, defaults, flush_interval=1.0, max_chats=10000):
+        self.open_backend = open_backend  # called once, on first use
+        self.backend = None
+        self.defaults = defaults
+        self.flush_interval = flush_interval
+        self.max_chats = max_chats
+        self._cache = OrderedDict()  # chat_id -> {key: value}, {} for chats without saved preferences
+        self._dirty = {}  # chat_id -> {key: value} not yet written
+        self._flushing = {}  # the same, for the batch being written right now
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def get(self, chat_id, key):
+        return self._prefs(chat_id).get(key, self.defaults.get(key))
+
+    def set(self, chat_id, key, value):
+        prefs = self._prefs(chat_id)
+        with self._lock:
+            prefs[key] = value
+            self._dirty.setdefault(chat_id, {})[key] = value
+
+    def language(self, chat_id):
+        """The chat's interface language, 'en' until one is picked"""
+        return self._prefs(chat_id).get('language', self.defaults['language'])
+
+    def set_language(self, chat_id, lang):
+        self.set(chat_id, 'language', lang)
+
+    def cached(self, chat_id):
+        """Whether the chat's preferences are in memory, i.e. a lookup won't touch the backend"""
+        with self._lock:
+            return chat_id in self._cache
+
+    def flush(self):
+        """Write the pending changes to the backend in one batch"""
+        if self.backend is None:
+            return
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                self._flushing = dirty
+            if not dirty:
+                return
+            try:
+                self.backend.save_many([
+                    (chat_id, key, value) for chat_id, values in dirty.items() for key, value in values.items()
+                ])
+            except Exception as e:
+                log_error('preferences_save', e, chats=len(dirty))
+                with self._lock:
+                    # Put them back unless the chat changed them again meanwhile
+                    for chat_id, values in dirty.items():
+                        pending = self._dirty.setdefault(chat_id, {})
+                        for key, value in values.items():
+                            pending.setdefault(key, value)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self.backend is None:
+            return
+        self.flush()
+        self.backend.close()
+
+    def _open(self):
+        with self._open_lock:
+            if self.backend is None:
+                self.backend = self.open_backend()
+                threading.Thread(target=self._flush_loop, name='preferences-flush', daemon=True).start()
+                atexit.register(self.close)
+        return self.backend
+
+    def _prefs(self, chat_id):
+        with self._lock:
+            prefs = self._cache.get(chat_id)
+            if prefs is not None:
+                self._cache.move_to_end(chat_id)
+                return prefs
+        return self._load(chat_id)
+
+    def _load(self, chat_id):
+        backend = self.backend or self._open()
+        try:
+            loaded = backend.load(chat_id)
+        except Exception as e:
+            log_error('preferences_load', e, chat_id=chat_id)
+            loaded = {}
+        with self._lock:
+            # Another thread may have loaded (and changed) it in the meantime
+            prefs = self._cache.get(chat_id)
+            if prefs is None:
+                # Changes of an evicted chat may not have reached the backend yet
+                loaded.update(self._flushing.get(chat_id, {}))
+                loaded.update(self._dirty.get(chat_id, {}))
+                prefs = self._cache[chat_id] = loaded
+                while len(self._cache) > self.max_chats:
+                    self._cache.popitem(last=False)
+            self._cache.move_to_end(chat_id)
+            return prefs
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+
+def open_store(backend='sqlite', path=None, defaults=None, flush_interval=1.0, max_chats=10000):
+    """PreferenceStore on the named backend: 'sqlite', 'kv' or 'memory', opened on first use"""
+    defaults = defaults or {'language': 'en'}
+    if backend == 'memory':
+        return PreferenceStore(MemoryBackend, defaults, flush_interval, max_chats)
+    # Fail on an unknown backend name now rather than on the first message
+    backend_class = BACKENDS[backend]
+    return PreferenceStore(lambda: backend_class(path), defaults, flush_interval, max_chats)
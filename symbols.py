@@ -0,0 +1,124 @@
+"""Coin registry: small stable IDs for callback data and O(1) symbol lookups.
+
+Every coin of the menu gets the integer ID of its position in the menu, and
+callbacks carry that ID instead of the coin's name. The registry can be
+checked against a local snapshot of Binance's exchangeInfo, read from disk at
+startup so it costs no request; coins whose symbol is missing from it or not
+trading are pruned from the menu and answered as unavailable, instead of
+sending klines and ticker requests that can only fail.
+
+Run `python symbols.py` to write a fresh snapshot.
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from cache import write_atomic
+from metrics import log_error
+
+EXCHANGE_INFO_PATH = os.environ.get("EXCHANGE_INFO_PATH", "data/exchange_info.json")
+# Older snapshots are still used, but refreshed in the background for the next start
+EXCHANGE_INFO_MAX_AGE = float(os.environ.get("EXCHANGE_INFO_MAX_AGE", 86400))
+
+Coin = namedtuple('Coin', 'id name symbol emoji label')
+
+
+class CoinRegistry:
+    """The menu's coins by ID and name, each lookup one list or dict access"""
+
+    def __init__(self, menu, symbols):
+        """`menu` lists "emoji Name (TICKER)" labels, `symbols` maps "Name (TICKER)" to the Binance symbol"""
+        self.coins = []
+        for coin_id, label in enumerate(menu):
+            emoji, name = label.split(' ', 1)
+            symbol = symbols.get(name)
+            if symbol is None:
+                raise ValueError(f"No Binance symbol for menu coin {name!r}")
+            self.coins.append(Coin(coin_id, name, symbol, emoji, label))
+        self.prune(None)
+
+    def prune(self, trading):
+        """Keep only the coins whose symbol is in `trading` (all of them for None), returns the dropped ones"""
+        self.listed = [coin for coin in self.coins if trading is None or coin.symbol in trading]
+        self.pruned = [coin for coin in self.coins if trading is not None and coin.symbol not in trading]
+        # Pruned coins keep their IDs, so callbacks already sent for them stay unambiguous
+        self._by_id = [None] * len(self.coins)
+        for coin in self.listed:
+            self._by_id[coin.id] = coin
+        self._by_name = {coin.name: coin for coin in self.listed}
+        return self.pruned
+
+    def get(self, coin_id):
+        """Listed coin with this ID, None for unknown or pruned ones"""
+        return self._by_id[coin_id] if 0 <= coin_id < len(self._by_id) else None
+
+    def by_name(self, name):
+        """Listed coin called "Name (TICKER)", None for unknown or pruned ones"""
+        return self._by_name.get(name)
+
+    def symbol(self, name):
+        """Binance symbol of a listed coin, None for unknown or pruned ones"""
+        coin = self._by_name.get(name)
+        return coin.symbol if coin else None
+
+    def symbols(self):
+        return [coin.symbol for coin in self.listed]
+
+    def __len__(self):
+        return len(self.listed)
+
+    def __iter__(self):
+        return iter(self.listed)
+
+
+def load_exchange_info(path=EXCHANGE_INFO_PATH):
+    """Read a snapshot written by save_exchange_info, returns (trading symbols, updated_at) or (None, 0)"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None, 0
+    except (OSError, ValueError) as e:
+        log_error('exchange_info_load', e, path=path)
+        return None, 0
+    trading = {symbol for symbol, status in snapshot['symbols'].items() if status == 'TRADING'}
+    return trading, snapshot.get('updated_at', 0)
+
+
+def save_exchange_info(client, path=EXCHANGE_INFO_PATH):
+    """Download exchangeInfo and keep the status of each symbol, returns the trading symbols"""
+    info = client.exchange_info()
+    snapshot = {
+        'updated_at': time.time(),
+        'symbols': {s['symbol']: s['status'] for s in info['symbols']},
+    }
+    write_atomic(path, lambda f: json.dump(snapshot, f, separators=(',', ':')))
+    return {symbol for symbol, status in snapshot['symbols'].items() if status == 'TRADING'}
+
+
+def refresh_in_background(client, updated_at, path=EXCHANGE_INFO_PATH, max_age=EXCHANGE_INFO_MAX_AGE):
+    """Rewrite a missing or stale snapshot on a daemon thread, it is picked up on the next start"""
+    if time.time() - updated_at <= max_age:
+        return None
+
+    def run():
+        try:
+            save_exchange_info(client, path)
+        except Exception as e:
+            log_error('exchange_info_refresh', e)
+
+    thread = threading.Thread(target=run, name='exchange-info', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    import bot as app
+
+    trading = save_exchange_info(app.binance)
+    missing = [coin.name for coin in app.coins.coins if coin.symbol not in trading]
+    print(f"Saved {EXCHANGE_INFO_PATH}, {len(trading)} trading symbols")
+    if missing:
+        print(f"Not trading, pruned on the next start: {', '.join(missing)}")
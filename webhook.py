@@ -0,0 +1,176 @@
+"""Webhook entry point for the Crypto Tracker Bot.
+
+Telegram pushes updates to a small local HTTP server instead of the bot long
+polling for them. Each POST is checked against the webhook secret, queued for
+bot.py's handlers and answered with 200 straight away. The server speaks plain
+HTTP; put it behind a TLS reverse proxy and point WEBHOOK_URL at the proxy.
+Start it with `python webhook.py` instead of `python bot.py`.
+"""
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+import bot as app
+from metrics import REGISTRY, log_error
+
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Public HTTPS URL Telegram should post to, registered with setWebhook on startup
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+
+# Telegram updates are a few KB, anything much bigger is not from Telegram
+MAX_BODY_BYTES = 1024 * 1024
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateDispatcher:
+    """Hand updates to `process` on a few threads, refusing new ones past `max_pending`"""
+
+    def __init__(self, process, workers=4, max_pending=256):
+        self.process = process
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook')
+        self._lock = threading.Lock()
+
+    def submit(self, update):
+        """Queue an update, returns False if too many are waiting already"""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+        self._executor.submit(self._run, update)
+        return True
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, update):
+        try:
+            self.process([update])
+        except Exception as e:
+            log_error('webhook_update', e, update_id=getattr(update, 'update_id', None))
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Keep Telegram's connections open between updates
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            return self.reject(404)
+
+        if server.secret and not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), server.secret):
+            return self.reject(403)
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return self.reject(400)
+        if length > MAX_BODY_BYTES:
+            return self.reject(413)
+
+        body = self.rfile.read(length)
+        try:
+            update = server.decode(body.decode('utf-8'))
+        except Exception as e:
+            log_error('webhook_decode', e)
+            return self.reply(400)
+
+        if not server.dispatcher.submit(update):
+            # Telegram retries later, by then the backlog has drained
+            return self.reply(503, {'Retry-After': '1'})
+        self.reply(200)
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            return self.reply(200, body=b'ok')
+        self.reply(404)
+
+    def reject(self, status):
+        """Reply without reading the body, and close the connection so it is not taken for the next request"""
+        self.close_connection = True
+        self.reply(status, {'Connection': 'close'})
+
+    def reply(self, status, headers=None, body=b''):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        app.logger.debug(f"Webhook {self.address_string()} {format % args}")
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP server that feeds the updates posted to `path` into `dispatcher`.
+
+    `dispatcher.submit(update)` gets each body as decoded by `decode`, and
+    returns False to have the update refused for now.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, decode=types.Update.de_json):
+        super().__init__(address, WebhookHandler)
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.decode = decode
+
+
+def create_server(host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                  dispatcher=None, decode=types.Update.de_json):
+    """Webhook server dispatching to bot.py's handlers, port 0 picks a free port"""
+    if dispatcher is None:
+        # Handle each update on the dispatcher's thread; threaded, telebot would hand it
+        # to its own unbounded pool and return at once, and max_pending would never fill
+        app.bot.threaded = False
+        dispatcher = UpdateDispatcher(
+            app.bot.process_new_updates,
+            workers=int(os.environ.get("WEBHOOK_WORKERS", 4)),
+            max_pending=int(os.environ.get("WEBHOOK_MAX_PENDING", 256))
+        )
+        REGISTRY.gauge('botrader_webhook_pending', 'Webhook updates queued or being handled', lambda: dispatcher.pending)
+    return WebhookServer((host, port), dispatcher, path, secret, decode)
+
+
+def main():
+    if not WEBHOOK_SECRET:
+        raise SystemExit("WEBHOOK_SECRET must be set, it is how updates are told apart from strangers' requests")
+
+    app.start_process_renderer()
+    app.ticker_snapshot.start()
+    app.start_exchange_info_refresh()
+    app.start_metrics_server()
+
+    if WEBHOOK_URL:
+        app.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+
+    server = create_server()
+    app.logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.dispatcher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
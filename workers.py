@@ -0,0 +1,180 @@
+"""Bounded worker pools for slow handler jobs, run in order per chat"""
+import asyncio
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from metrics import log_error, log_event
+
+JOB_ACCEPTED = 'accepted'
+JOB_DUPLICATE = 'duplicate'
+JOB_BUSY = 'busy'
+
+# values: {name: result or None}; timings: {name: seconds} of the tasks that finished;
+# elapsed: wall time of the stage; critical: (name, seconds) of the slowest task, the
+# one the stage waited on; late: names of the tasks that missed the deadline
+StageResult = namedtuple('StageResult', 'values timings elapsed critical late')
+
+
+class ChatJobQueue:
+    """Run slow jobs on named thread pools while keeping each chat's jobs in order.
+
+    A chat has at most one job running at a time; later jobs from the same chat
+    wait behind it and start when it finishes. A job whose key is already
+    queued or running for that chat is dropped as a duplicate click, and a pool
+    that already holds `max_pending` jobs turns new ones away as busy.
+    """
+
+    def __init__(self, pools, max_pending=32, max_per_chat=3):
+        # pools: {name: worker_count}
+        self._executors = {
+            name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-worker')
+            for name, workers in pools.items()
+        }
+        self.max_pending = max_pending
+        self.max_per_chat = max_per_chat
+        self._pending = {name: 0 for name in pools}  # queued + running jobs per pool
+        self._chats = {}  # chat_id -> deque of jobs, the head one is running
+        self._keys = set()  # (chat_id, key) of every queued or running job
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, pool, key, fn, *args):
+        """Queue `fn(*args)` for `chat_id` on `pool`, returns JOB_ACCEPTED, JOB_DUPLICATE or JOB_BUSY"""
+        job = (pool, key, fn, args)
+        with self._lock:
+            if (chat_id, key) in self._keys:
+                return JOB_DUPLICATE
+
+            queue = self._chats.get(chat_id)
+            if self._pending[pool] >= self.max_pending or (queue and len(queue) >= self.max_per_chat):
+                return JOB_BUSY
+
+            self._keys.add((chat_id, key))
+            self._pending[pool] += 1
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+            queue.append(job)
+            start = len(queue) == 1
+
+        if start:
+            self._start(chat_id, job)
+        return JOB_ACCEPTED
+
+    def depth(self, pool):
+        """Number of queued and running jobs on `pool`"""
+        with self._lock:
+            return self._pending[pool]
+
+    def shutdown(self, wait=True):
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
+
+    def _start(self, chat_id, job):
+        self._executors[job[0]].submit(self._run, chat_id, job)
+
+    def _run(self, chat_id, job):
+        pool, key, fn, args = job
+        try:
+            fn(*args)
+        except Exception as e:
+            log_error('job', e, pool=pool, key=key)
+        finally:
+            with self._lock:
+                self._keys.discard((chat_id, key))
+                self._pending[pool] -= 1
+                queue = self._chats[chat_id]
+                queue.popleft()
+                next_job = queue[0] if queue else None
+                if not queue:
+                    del self._chats[chat_id]
+
+            if next_job is not None:
+                self._start(chat_id, next_job)
+
+
+class ParallelStage:
+    """Run the independent calls a request needs side by side under one deadline.
+
+    Tasks that fail, or are still running when the deadline passes, come back
+    as None so the caller can decide what it can do without them.
+    """
+
+    def __init__(self, name, max_workers=8):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-stage')
+
+    def run(self, tasks, timeout=None):
+        """Run {name: (fn, *args)} concurrently, waiting at most `timeout` seconds for all"""
+        started = time.perf_counter()
+        futures = {
+            self._executor.submit(self._timed, fn, *args): name
+            for name, (fn, *args) in tasks.items()
+        }
+        done, late = wait(futures, timeout=timeout)
+
+        values, timings = {}, {}
+        for future, name in futures.items():
+            values[name] = None
+            if future not in done:
+                future.cancel()
+                continue
+            try:
+                values[name], timings[name] = future.result()
+            except Exception as e:
+                log_error('stage_task', e, stage=self.name, task=name)
+
+        critical = max(timings.items(), key=lambda item: item[1], default=(None, 0.0))
+        return StageResult(
+            values,
+            timings,
+            time.perf_counter() - started,
+            critical,
+            [futures[future] for future in late],
+        )
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    @staticmethod
+    async def run_async(name, coros, timeout=None):
+        """Asyncio counterpart of run for {name: coroutine}, late ones are cancelled"""
+        started = time.perf_counter()
+        timings = {}
+
+        async def timed(task_name, coro):
+            task_started = time.perf_counter()
+            value = await coro
+            timings[task_name] = time.perf_counter() - task_started
+            return value
+
+        tasks = {asyncio.ensure_future(timed(task_name, coro)): task_name for task_name, coro in coros.items()}
+        done, late = await asyncio.wait(tasks, timeout=timeout)
+
+        values = {}
+        for task, task_name in tasks.items():
+            values[task_name] = None
+            if task not in done:
+                task.cancel()
+            elif task.cancelled():
+                # exception() raises on a cancelled task
+                log_event('stage_task_cancelled', stage=name, task=task_name)
+            elif task.exception() is not None:
+                log_error('stage_task', task.exception(), stage=name, task=task_name)
+            else:
+                values[task_name] = task.result()
+
+        critical = max(timings.items(), key=lambda item: item[1], default=(None, 0.0))
+        return StageResult(
+            values,
+            timings,
+            time.perf_counter() - started,
+            critical,
+            [tasks[task] for task in late],
+        )
+
+    @staticmethod
+    def _timed(fn, *args):
+        started = time.perf_counter()
+        value = fn(*args)
+        return value, time.perf_counter() - started